@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""
+Load generator for the continuous-batching server in `silen_lib/transformers/server.py`.
+
+For each request rate, sends requests with Poisson arrivals (so they overlap like real traffic) and reports p50/p99
+latency, time to first token and generated tokens/s. Start the server first, e.g.
+
+    python -m silen_lib.transformers.server --model gpt2
+    python scripts/benchmark-server.py --rates 1 2 4 8 16
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import statistics
+import time
+
+PROMPTS = [
+    "Once upon a time, there was a little girl named Lily. She",
+    "The ships hung in the sky in much the same way that",
+    "In a shocking finding, scientist discovered a herd of unicorns living in a remote, previously unexplored valley",
+    "John and Mary went to the",
+    "Jingle bells, jingle bells, jingle all the way",
+]
+
+
+async def request(
+    host: str, port: int, method: str, path: str, payload: dict | None = None
+) -> dict:
+    """Sends one HTTP request to the server, and returns the JSON response."""
+    reader, writer = await asyncio.open_connection(host, port)
+    body = b"" if payload is None else json.dumps(payload).encode()
+    writer.write(
+        f"{method} {path} HTTP/1.1\r\nHost: {host}\r\nContent-Type: application/json\r\n"
+        f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+    )
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    status_line, _, response_body = response.partition(b"\r\n\r\n")
+    if b" 200 " not in status_line.split(b"\r\n")[0]:
+        raise RuntimeError(f"Request failed: {response!r}")
+    return json.loads(response_body)
+
+
+async def run_load(args: argparse.Namespace, rate: float) -> dict:
+    """Sends `args.num_requests` requests at an average of `rate` per second, and returns latency statistics."""
+    rng = random.Random(args.seed)
+    responses = []
+
+    async def send(i: int) -> None:
+        start = time.perf_counter()
+        payload = {
+            "prompt": PROMPTS[i % len(PROMPTS)],
+            "max_tokens_generated": args.max_tokens,
+            "temperature": args.temperature,
+            "seed": i,
+        }
+        response = await request(args.host, args.port, "POST", "/generate", payload)
+        responses.append({**response, "client_latency": time.perf_counter() - start})
+
+    start = time.perf_counter()
+    tasks = []
+    for i in range(args.num_requests):
+        tasks.append(asyncio.create_task(send(i)))
+        await asyncio.sleep(rng.expovariate(rate))
+    # Sample the server's metrics while the tail of the requests is still running
+    metrics = await request(args.host, args.port, "GET", "/metrics")
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - start
+
+    latencies = [r["client_latency"] for r in responses]
+    percentiles = statistics.quantiles(latencies, n=100)
+    return {
+        "rate": rate,
+        "p50": percentiles[49],
+        "p99": percentiles[98],
+        "ttft_p50": statistics.median(r["time_to_first_token"] for r in responses),
+        "tokens_per_second": sum(r["n_tokens"] for r in responses) / elapsed,
+        "batch_size": metrics["batch_size"],
+        "queue_depth": metrics["queue_depth"],
+    }
+
+
+async def main(args: argparse.Namespace) -> None:
+    print(
+        f"{'req/s':>6} {'p50 (s)':>8} {'p99 (s)':>8} {'TTFT p50':>9} {'tok/s':>8} {'batch':>6} {'queue':>6}"
+    )
+    for rate in args.rates:
+        r = await run_load(args, rate)
+        print(
+            f"{r['rate']:>6.1f} {r['p50']:>8.2f} {r['p99']:>8.2f} {r['ttft_p50']:>9.2f} "
+            f"{r['tokens_per_second']:>8.1f} {r['batch_size']:>6} {r['queue_depth']:>6}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Measure latency against request rate for the inference server"
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--rates", type=float, nargs="+", default=[1, 2, 4, 8, 16])
+    parser.add_argument("--num-requests", type=int, default=100)
+    parser.add_argument("--max-tokens", type=int, default=32)
+    parser.add_argument("--temperature", type=float, default=1.0)
+    parser.add_argument("--seed", type=int, default=0)
+    asyncio.run(main(parser.parse_args()))
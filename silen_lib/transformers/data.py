@@ -0,0 +1,358 @@
+"""
+Pre-tokenized datasets stored as flat token files, for training `DemoTransformer` without re-tokenizing every run.
+
+`write_token_bin` tokenizes a corpus once, writing every document's token ids (each followed by the end-of-text token)
+back to back to `{path}.bin` as uint16, plus the offset where each document starts to `{path}.idx`.
+`MemmapTokenDataset` then memory-maps the tokens and serves fixed-length windows, so opening a dataset takes
+milliseconds, and only the pages we actually read are loaded (and can be dropped again by the OS).
+`StreamingTokenDataset` streams windows from many such shards (or from raw text shards, tokenized on the fly) with a
+bounded shuffle buffer, for corpora too big to index up front, and can resume mid-epoch.
+
+Tokenize TinyStories with `python -m silen_lib.transformers.data --out data/tinystories`, which writes
+`data/tinystories-train.{bin,idx}` and `data/tinystories-validation.{bin,idx}`.
+"""
+
+import argparse
+import itertools
+import json
+import os
+from pathlib import Path
+from typing import Iterable, Iterator
+
+import numpy as np
+import torch as t
+from jaxtyping import Int
+from torch import Tensor
+from torch.utils.data import Dataset, IterableDataset, get_worker_info
+from transformers import PreTrainedTokenizerBase
+
+
+def token_bin_paths(path: str | Path) -> tuple[Path, Path]:
+    """Returns the token file and index file for the dataset at `path`."""
+    return Path(f"{path}.bin"), Path(f"{path}.idx")
+
+
+def token_bin_exists(path: str | Path) -> bool:
+    """Whether `write_token_bin` has finished writing the dataset at `path` (the index is written last)."""
+    return all(p.exists() for p in token_bin_paths(path))
+
+
+def write_token_bin(
+    texts: Iterable[str],
+    tokenizer: PreTrainedTokenizerBase,
+    path: str | Path,
+    batch_size: int = 1000,
+) -> int:
+    """
+    Tokenizes `texts`, and writes the token ids of each one followed by the end-of-text token to `{path}.bin` (as
+    uint16), and the start offset of each text plus the total number of tokens to `{path}.idx` (as an int64 `.npy`).
+    Returns the number of tokens written.
+    """
+    assert len(tokenizer) <= 2**16, "Token ids need to fit in uint16"
+    bin_path, idx_path = token_bin_paths(path)
+    bin_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = bin_path.with_name(bin_path.name + ".tmp")
+    idx_path.unlink(missing_ok=True)
+
+    doc_lengths = []
+    texts = iter(texts)
+    with open(tmp_path, "wb") as f:
+        while batch := list(itertools.islice(texts, batch_size)):
+            input_ids = tokenizer(batch)["input_ids"]
+            doc_tokens = [ids + [tokenizer.eos_token_id] for ids in input_ids]
+            np.concatenate(doc_tokens).astype(np.uint16).tofile(f)
+            doc_lengths.extend(len(tokens) for tokens in doc_tokens)
+
+    # Only rename the tokens into place once they're complete, and write the index after them
+    os.replace(tmp_path, bin_path)
+    offsets = np.concatenate([[0], np.cumsum(doc_lengths, dtype=np.int64)])
+    with open(idx_path, "wb") as f:
+        np.save(f, offsets)
+    return int(offsets[-1])
+
+
+def document_segment_ids(
+    doc_offsets: np.ndarray, positions: Int[np.ndarray, "... n"]
+) -> Int[np.ndarray, "... n"]:
+    """
+    Returns the document each token position belongs to, counted from the document of the first position in each row.
+
+    Each document's end-of-text token is counted as the start of the next document, where it plays the part of a BOS
+    token (so with GPT-2's tokenizer, every document except the very first starts with BOS, as it would on its own).
+    """
+    docs = np.searchsorted(doc_offsets, positions + 1, side="right") - 1
+    return docs - docs[..., :1]
+
+
+def prepend_bos(item: dict[str, Tensor], bos_token_id: int | None) -> dict[str, Tensor]:
+    """Prepends `bos_token_id` (if it's not None) to the tokens, and puts it in the first token's segment."""
+    if bos_token_id is None:
+        return item
+    bos = t.full((*item["tokens"].shape[:-1], 1), bos_token_id, dtype=t.int64)
+    item["tokens"] = t.cat([bos, item["tokens"]], dim=-1)
+    if "segment_ids" in item:
+        item["segment_ids"] = t.cat([item["segment_ids"][..., :1], item["segment_ids"]], dim=-1)
+    return item
+
+
+class MemmapTokenDataset(Dataset):
+    """
+    Fixed-length windows of the tokens written by `write_token_bin`, read from a memory map.
+
+    Window `i` covers tokens `[i * stride, (i + 1) * stride)`, where the stride is `n_ctx` (or `n_ctx - 1` if
+    `bos_token_id` is given, in which case every window starts with it, like `tokenize_and_concatenate` with
+    `add_bos_token=True`). Items are dicts with a single key "tokens", so batches look the same as those of a tokenized
+    HuggingFace dataset. Integer indices give one window, and slices give a stacked batch of them.
+
+    With `return_segment_ids=True`, windows are packed for document masking: items also have "segment_ids", saying
+    which document each token belongs to (see `document_segment_ids`), for `DemoTransformer`'s `segment_ids`.
+
+    The memory map is opened lazily and isn't pickled, so DataLoader workers each open their own rather than being sent
+    a copy of the tokens.
+    """
+
+    def __init__(
+        self,
+        path: str | Path,
+        n_ctx: int,
+        bos_token_id: int | None = None,
+        return_segment_ids: bool = False,
+    ):
+        self.path = Path(path)
+        self.n_ctx = n_ctx
+        self.bos_token_id = bos_token_id
+        self.return_segment_ids = return_segment_ids
+        self.stride = n_ctx if bos_token_id is None else n_ctx - 1
+        self.bin_path, self.idx_path = token_bin_paths(path)
+        self.n_tokens = self.bin_path.stat().st_size // np.dtype(np.uint16).itemsize
+        self._tokens = None
+        self._doc_offsets = None
+
+    @property
+    def tokens(self) -> np.memmap:
+        """All the tokens, as a read-only uint16 memory map."""
+        if self._tokens is None:
+            self._tokens = np.memmap(self.bin_path, dtype=np.uint16, mode="r")
+        return self._tokens
+
+    @property
+    def doc_offsets(self) -> np.ndarray:
+        """Start offset of every document in `tokens`, followed by the total number of tokens."""
+        if self._doc_offsets is None:
+            self._doc_offsets = np.load(self.idx_path)
+        return self._doc_offsets
+
+    def __getstate__(self) -> dict:
+        return {**self.__dict__, "_tokens": None, "_doc_offsets": None}
+
+    def __len__(self) -> int:
+        return self.n_tokens // self.stride
+
+    def __getitem__(self, idx: int | slice) -> dict[str, Int[Tensor, "... n_ctx"]]:
+        windows = range(len(self))[idx]
+        if isinstance(windows, range):
+            assert windows.step == 1, "Only contiguous slices are supported"
+            start, stop = windows.start * self.stride, windows.stop * self.stride
+            shape = (len(windows), self.stride)
+        else:
+            start, stop = windows * self.stride, (windows + 1) * self.stride
+            shape = (self.stride,)
+
+        # Embeddings need int64 indices, so this converts (and copies) the window, but nothing else gets read
+        item = {"tokens": t.from_numpy(self.tokens[start:stop].reshape(shape).astype(np.int64))}
+        if self.return_segment_ids:
+            positions = np.arange(start, stop).reshape(shape)
+            item["segment_ids"] = t.from_numpy(document_segment_ids(self.doc_offsets, positions))
+        return prepend_bos(item, self.bos_token_id)
+
+
+TEXT_SHARD_SUFFIXES = (".txt", ".jsonl")
+
+
+class StreamingTokenDataset(IterableDataset):
+    """
+    Shuffled `n_ctx` windows streamed from a list of shards, without reading any shard up front.
+
+    Each shard is either a token file prefix written by `write_token_bin`, or a text file which is tokenized on the fly
+    (`.txt` with one document per line, or `.jsonl` with the document in `text_column`). Windows are packed from each
+    shard's tokens like `MemmapTokenDataset` (the last partial window of a shard is dropped), and are shuffled with a
+    buffer of `shuffle_buffer_size` windows, so memory use doesn't depend on the size of the corpus. Windows from token
+    shards can also have "segment_ids" for document masking, with `return_segment_ids=True` (as for
+    `MemmapTokenDataset`).
+
+    The shard order is reshuffled every epoch (see `set_epoch`). With several DataLoader workers, text shards are split
+    between them (worker `w` of `N` takes every `N`-th shard), while token shards are split window by window, so that
+    even a single token shard keeps every worker busy. The split only depends on `seed`, the epoch & the number of
+    workers, so each worker's stream is deterministic.
+
+    Every item has a "stream_position" of `(stream_id, num_workers, index)` alongside its "tokens", where the stream is
+    the worker's share of the epoch. Passing each batch you train on to `advance` lets `state_dict` record how far each
+    stream got, and a dataset restored with `load_state_dict` skips exactly those windows, and hands the streams to the
+    workers so that the DataLoader's round-robin over them carries on where it stopped. For token shards, skipping only
+    replays the shuffle on window offsets, so it's fast; text shards have to be tokenized again up to the cursor.
+    """
+
+    def __init__(
+        self,
+        shards: Iterable[str | Path],
+        n_ctx: int,
+        bos_token_id: int | None = None,
+        tokenizer: PreTrainedTokenizerBase | None = None,
+        text_column: str = "text",
+        shuffle_buffer_size: int = 1000,
+        seed: int = 0,
+        return_segment_ids: bool = False,
+    ):
+        self.shards = [Path(shard) for shard in shards]
+        self.is_text = [shard.suffix in TEXT_SHARD_SUFFIXES for shard in self.shards]
+        assert tokenizer is not None or not any(self.is_text), "Text shards need a tokenizer"
+        assert not (return_segment_ids and any(self.is_text)), "Text shards have no segment ids"
+        self.return_segment_ids = return_segment_ids
+        self.n_ctx = n_ctx
+        self.bos_token_id = bos_token_id
+        self.stride = n_ctx if bos_token_id is None else n_ctx - 1
+        self.tokenizer = tokenizer
+        self.text_column = text_column
+        self.shuffle_buffer_size = shuffle_buffer_size
+        self.seed = seed
+        self.epoch = 0
+        self.num_workers = None
+        self.consumed: dict[int, int] = {}
+        self.next_stream = 0
+
+    def set_epoch(self, epoch: int) -> None:
+        """Sets the epoch (which determines the shuffle), resetting the cursor unless it's the current epoch."""
+        if epoch != self.epoch:
+            self.epoch = epoch
+            self.consumed = {}
+            self.next_stream = 0
+
+    def advance(self, batch: dict[str, Tensor]) -> None:
+        """Records that `batch`, from a DataLoader over this dataset, has been consumed."""
+        for stream_id, num_workers, index in batch["stream_position"].tolist():
+            self.num_workers = num_workers
+            self.consumed[stream_id] = max(self.consumed.get(stream_id, 0), index + 1)
+            self.next_stream = (stream_id + 1) % num_workers
+
+    def state_dict(self) -> dict:
+        return {
+            "epoch": self.epoch,
+            "num_workers": self.num_workers,
+            "consumed": dict(self.consumed),
+            "next_stream": self.next_stream,
+        }
+
+    def load_state_dict(self, state_dict: dict) -> None:
+        self.epoch = state_dict["epoch"]
+        self.num_workers = state_dict["num_workers"]
+        self.consumed = {int(k): v for k, v in state_dict["consumed"].items()}
+        self.next_stream = state_dict["next_stream"]
+
+    def text_windows(self, shard: Path) -> Iterator[np.ndarray]:
+        """Tokenizes the documents in a text shard, and packs them into windows of `stride` tokens."""
+        with open(shard, encoding="utf-8") as f:
+            if shard.suffix == ".jsonl":
+                docs = (json.loads(line)[self.text_column] for line in f if line.strip())
+            else:
+                docs = (line.rstrip("\n") for line in f if line.strip())
+            buffer = np.empty(0, dtype=np.int64)
+            while batch := list(itertools.islice(docs, 1000)):
+                input_ids = self.tokenizer(batch)["input_ids"]
+                tokens = [ids + [self.tokenizer.eos_token_id] for ids in input_ids]
+                buffer = np.concatenate([buffer, *map(np.asarray, tokens)])
+                n_windows = len(buffer) // self.stride
+                yield from buffer[: n_windows * self.stride].reshape(n_windows, self.stride)
+                buffer = buffer[n_windows * self.stride :]
+
+    def windows(self, stream_id: int, num_workers: int) -> Iterator[tuple[int, int] | np.ndarray]:
+        """
+        Yields the windows of a worker's stream for the current epoch, in shard order. Windows of token shards are given
+        as `(shard_idx, start)` offsets rather than tokens, so they're only read once they leave the shuffle buffer.
+        """
+        shard_order = np.random.default_rng((self.seed, self.epoch)).permutation(len(self.shards))
+        text_shards = [i for i in shard_order if self.is_text[i]]
+        for shard_idx in shard_order:
+            if self.is_text[shard_idx]:
+                if text_shards.index(shard_idx) % num_workers == stream_id:
+                    yield from self.text_windows(self.shards[shard_idx])
+            else:
+                n_tokens = (
+                    token_bin_paths(self.shards[shard_idx])[0].stat().st_size
+                    // np.dtype(np.uint16).itemsize
+                )
+                for start in range(
+                    stream_id * self.stride, n_tokens - self.stride + 1, num_workers * self.stride
+                ):
+                    yield (shard_idx, start)
+
+    def __iter__(self) -> Iterator[dict[str, Tensor]]:
+        worker_info = get_worker_info()
+        worker_id, num_workers = (
+            (0, 1) if worker_info is None else (worker_info.id, worker_info.num_workers)
+        )
+        if self.consumed and self.num_workers != num_workers:
+            raise ValueError(
+                f"Can't resume a stream from {self.num_workers} workers with {num_workers} workers"
+            )
+        # The DataLoader takes batches from its workers in turn starting with worker 0, which should get the stream that
+        # was next when the cursor was saved
+        stream_id = (worker_id + self.next_stream) % num_workers
+        n_skip = self.consumed.get(stream_id, 0)
+
+        rng = np.random.default_rng((self.seed, self.epoch, stream_id))
+        windows = self.shuffle(self.windows(stream_id, num_workers), rng)
+        token_shards = {}
+        for index, window in enumerate(windows):
+            if index < n_skip:
+                continue
+            item = {}
+            if isinstance(window, tuple):
+                shard_idx, start = window
+                if shard_idx not in token_shards:
+                    token_shards[shard_idx] = MemmapTokenDataset(self.shards[shard_idx], self.n_ctx)
+                shard = token_shards[shard_idx]
+                window = shard.tokens[start : start + self.stride]
+                if self.return_segment_ids:
+                    positions = np.arange(start, start + self.stride)
+                    segment_ids = document_segment_ids(shard.doc_offsets, positions)
+                    item["segment_ids"] = t.from_numpy(segment_ids)
+            item["tokens"] = t.from_numpy(window.astype(np.int64))
+            item = prepend_bos(item, self.bos_token_id)
+            item["stream_position"] = t.tensor([stream_id, num_workers, index])
+            yield item
+
+    def shuffle(self, windows: Iterator, rng: np.random.Generator) -> Iterator:
+        """Shuffles with a buffer: each new window takes the place of a random buffered one, which is yielded."""
+        buffer = []
+        for window in windows:
+            if len(buffer) < max(self.shuffle_buffer_size, 1):
+                buffer.append(window)
+                continue
+            i = rng.integers(len(buffer))
+            yield buffer[i]
+            buffer[i] = window
+        rng.shuffle(buffer)
+        yield from buffer
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Tokenize a dataset into flat uint16 token files")
+    parser.add_argument("--dataset", default="roneneldan/TinyStories")
+    parser.add_argument("--splits", nargs="+", default=["train", "validation"])
+    parser.add_argument("--column", default="text")
+    parser.add_argument("--tokenizer", default="gpt2")
+    parser.add_argument("--out", default="data/tinystories", help="Prefix for the output files")
+    args = parser.parse_args()
+
+    import datasets
+    from transformers import AutoTokenizer
+
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer)
+    for split in args.splits:
+        dataset = datasets.load_dataset(args.dataset, split=split)
+        n_tokens = write_token_bin(dataset[args.column], tokenizer, f"{args.out}-{split}")
+        print(f"{split}: wrote {n_tokens:,} tokens from {len(dataset):,} documents")
+
+
+if __name__ == "__main__":
+    main()
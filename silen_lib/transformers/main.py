@@ -1,30 +1,44 @@
 # %%
 
 
+import contextlib
+import copy
+import itertools
 import math
 import os
 import sys
-from collections import defaultdict
-from dataclasses import dataclass
+import time
+from collections import OrderedDict, defaultdict
+from dataclasses import dataclass, replace
 from pathlib import Path
-from typing import Callable
+from typing import Callable, ContextManager, Iterable, Iterator
 
 import datasets
 import einops
 import numpy as np
 import torch as t
 import torch.nn as nn
+import torch.nn.functional as F
+import torch.utils.checkpoint
 import wandb
-from jaxtyping import Float, Int
+from jaxtyping import Bool, Float, Int
 from rich import print as rprint
 from rich.table import Table
 from torch import Tensor
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, Dataset, IterableDataset, Subset
 from tqdm.notebook import tqdm
 from transformer_lens import HookedTransformer
-from transformer_lens.utils import gelu_new, tokenize_and_concatenate
+from transformer_lens.utils import gelu_new
 from transformers.models.gpt2.tokenization_gpt2_fast import GPT2TokenizerFast
 
+from silen_lib.transformers.data import (
+    MemmapTokenDataset,
+    StreamingTokenDataset,
+    token_bin_exists,
+    write_token_bin,
+)
+from silen_lib.utils import benchmark, peak_rss_mb, set_seed
+
 device = t.device(
     "mps" if t.backends.mps.is_available() else "cuda" if t.cuda.is_available() else "cpu"
 )
@@ -156,6 +170,15 @@ class Config:
     d_mlp: int = 3072
     n_heads: int = 12
     n_layers: int = 12
+    # Attention implementation: "einsum" (reference), "sdpa" (fused QKV + PyTorch's SDPA kernel) or "flash" (tiled,
+    # see `flash_attention`), and the query/key block size used by "flash"
+    attn_impl: str = "einsum"
+    attn_block_size: int = 128
+    # LayerNorm implementation: "fused" (a single `F.layer_norm` kernel) or "manual" (the reference, written out)
+    ln_impl: str = "fused"
+    # Number of `TransformerBlock`s (starting from the first) whose activations aren't stored for the backward pass when
+    # training, but recomputed from the block's input instead. More blocks trades compute for memory.
+    checkpoint_blocks: int = 0
 
 
 if MAIN:
@@ -225,13 +248,21 @@ class LayerNorm(nn.Module):
     def forward(
         self, residual: Float[Tensor, "batch posn d_model"]
     ) -> Float[Tensor, "batch posn d_model"]:
+        # Always normalize in fp32, since the variance of bf16 / fp16 activations is too imprecise
+        input_dtype = residual.dtype
+        residual = residual.float()
+        if self.cfg.ln_impl == "fused":
+            return F.layer_norm(
+                residual, (self.cfg.d_model,), self.w, self.b, self.cfg.layer_norm_eps
+            ).to(input_dtype)
+
         residual_mean = residual.mean(dim=-1, keepdim=True)
         residual_std = (
             residual.var(dim=-1, keepdim=True, unbiased=False) + self.cfg.layer_norm_eps
         ).sqrt()
 
         residual = (residual - residual_mean) / residual_std
-        return residual * self.w + self.b
+        return (residual * self.w + self.b).to(input_dtype)
 
 
 if MAIN:
@@ -241,6 +272,31 @@ if MAIN:
 
 # %%
 
+if MAIN:
+    # The fused LayerNorm should match the manual reference (they share parameters, so the state dict is the same),
+    # and we compare their speed & extra memory on a full batch of GPT-2 small residuals
+    ln_manual = LayerNorm(Config(ln_impl="manual")).to(device)
+    ln_fused = LayerNorm(Config(ln_impl="fused")).to(device)
+    ln_manual.load_state_dict(reference_gpt2.ln_final.state_dict(), strict=False)
+    ln_fused.load_state_dict(ln_manual.state_dict())
+    x = cache["resid_post", 11]
+    t.testing.assert_close(ln_fused(x), ln_manual(x), atol=1e-5, rtol=1e-5)
+
+    x = t.randn(8, 1024, 768, device=device)
+    table = Table("impl", "forward (ms)", "forward + backward (ms)", "extra memory (MB)")
+    for name, ln in [("manual", ln_manual), ("fused", ln_fused)]:
+        x_grad = x.clone().requires_grad_()
+        with t.inference_mode():
+            time_forward = benchmark(lambda: ln(x))
+            extra_mb = peak_rss_mb(lambda: ln(x)) if device.type == "cpu" else float("nan")
+        time_backward = benchmark(lambda: ln(x_grad).sum().backward())
+        table.add_row(
+            name, f"{time_forward * 1e3:.2f}", f"{time_backward * 1e3:.2f}", f"{extra_mb:.0f}"
+        )
+    rprint(table)
+
+# %%
+
 
 class Embed(nn.Module):
     def __init__(self, cfg: Config):
@@ -270,10 +326,22 @@ class PosEmbed(nn.Module):
         nn.init.normal_(self.W_pos, std=self.cfg.init_range)
 
     def forward(
-        self, tokens: Int[Tensor, "batch position"]
+        self,
+        tokens: Int[Tensor, "batch position"],
+        offset: int = 0,
+        position_ids: Int[Tensor, "batch position"] | None = None,
     ) -> Float[Tensor, "batch position d_model"]:
+        """
+        `offset` is the position of the first token in `tokens` (non-zero when earlier positions are already held in
+        a key/value cache). Alternatively `position_ids` gives the position of every token explicitly, which is needed
+        when sequences in the batch are padded to different lengths.
+
+        Without `position_ids`, the result is a view of `W_pos` broadcast over the batch, rather than a copy.
+        """
+        if position_ids is not None:
+            return self.W_pos[position_ids]
         batch, seq_len = tokens.shape
-        return einops.repeat(self.W_pos[:seq_len], "seq d_model -> batch seq d_model", batch=batch)
+        return self.W_pos[offset : offset + seq_len].expand(batch, -1, -1)
 
 
 if MAIN:
@@ -285,11 +353,17 @@ if MAIN:
 
 class Attention(nn.Module):
     IGNORE: Float[Tensor, ""]
+    mask: Bool[Tensor, "n_ctx n_ctx"]
 
     def __init__(self, cfg: Config):
         super().__init__()
         self.cfg = cfg
         self.register_buffer("IGNORE", t.tensor(float("-inf"), dtype=t.float32, device=device))
+        self.register_buffer(
+            "mask",
+            t.triu(t.ones(cfg.n_ctx, cfg.n_ctx, dtype=t.bool, device=device), diagonal=1),
+            persistent=False,
+        )
 
     def apply_causal_mask(
         self,
@@ -298,9 +372,10 @@ class Attention(nn.Module):
         """
         Applies a causal mask to attention scores, and returns masked scores.
         """
-        # Define a mask that is True for all positions we want to set probabilities to zero for
-        all_ones = t.ones(attn_scores.size(-2), attn_scores.size(-1), device=attn_scores.device)
-        mask = t.triu(all_ones, diagonal=1).bool()
+        # Define a mask that is True for all positions we want to set probabilities to zero for (we slice it out of
+        # the mask precomputed for the whole context, rather than allocating a new one every call)
+        n_query, n_key = attn_scores.size(-2), attn_scores.size(-1)
+        mask = self.mask[n_key - n_query : n_key, :n_key]
         # Apply the mask to attention scores, then return the masked scores
         attn_scores.masked_fill_(mask, self.IGNORE)
         return attn_scores
@@ -333,8 +408,347 @@ if MAIN:
 # %%
 
 
+class KeyValueCacheEntry:
+    """Keys and values computed so far by a single attention layer."""
+
+    def __init__(self):
+        self.k: Float[Tensor, "batch posn nheads d_head"] | None = None
+        self.v: Float[Tensor, "batch posn nheads d_head"] | None = None
+
+    def update(
+        self,
+        k: Float[Tensor, "batch posn nheads d_head"],
+        v: Float[Tensor, "batch posn nheads d_head"],
+    ) -> tuple[
+        Float[Tensor, "batch posn_K nheads d_head"], Float[Tensor, "batch posn_K nheads d_head"]
+    ]:
+        """
+        Appends the keys and values for the new positions, and returns the keys and values for all positions so far.
+        """
+        if self.k is not None:
+            k = t.cat([self.k, k], dim=1)
+            v = t.cat([self.v, v], dim=1)
+        self.k, self.v = k, v
+        return k, v
+
+
+class KeyValueCache:
+    """
+    Per-layer key/value cache for incremental decoding. The first forward pass fills it from the whole prompt, and
+    every later pass only needs to be given the new token(s).
+    """
+
+    def __init__(self, cfg: Config):
+        self.cfg = cfg
+        self.entries = [KeyValueCacheEntry() for _ in range(cfg.n_layers)]
+
+    def __getitem__(self, layer: int) -> KeyValueCacheEntry:
+        return self.entries[layer]
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    @property
+    def seq_len(self) -> int:
+        """Number of positions currently held in the cache."""
+        k = self.entries[0].k
+        return 0 if k is None else k.size(1)
+
+    def select(self, indices: Int[Tensor, "new_batch"]) -> "KeyValueCache":
+        """
+        Returns a new cache made of the given batch rows of this one (e.g. to follow beams as they're reordered,
+        duplicated or dropped during beam search). This cache is left unchanged.
+        """
+        new_cache = KeyValueCache(self.cfg)
+        for entry, new_entry in zip(self.entries, new_cache.entries):
+            if entry.k is not None:
+                new_entry.k, new_entry.v = entry.k[indices], entry.v[indices]
+        return new_cache
+
+    def truncate(self, seq_len: int) -> None:
+        """Drops every position after the first `seq_len` (e.g. draft tokens rejected in speculative decoding)."""
+        for entry in self.entries:
+            if entry.k is not None:
+                entry.k, entry.v = entry.k[:, :seq_len], entry.v[:, :seq_len]
+
+
+# %%
+
+
+class BlockPool:
+    """
+    Preallocated storage for paged keys & values: `num_blocks` blocks of `block_size` positions, for every layer.
+    Blocks are reference counted, so several sequences can share them (e.g. beams with a common prompt).
+    """
+
+    def __init__(
+        self,
+        cfg: Config,
+        num_blocks: int,
+        block_size: int = 16,
+        device: t.device | str = device,
+        dtype: t.dtype = t.float32,
+    ):
+        self.cfg = cfg
+        self.num_blocks = num_blocks
+        self.block_size = block_size
+        # Keys & values for every slot (a slot is a position within a block, i.e. slot = block * block_size + offset)
+        self.k = t.zeros(
+            cfg.n_layers,
+            num_blocks * block_size,
+            cfg.n_heads,
+            cfg.d_head,
+            device=device,
+            dtype=dtype,
+        )
+        self.v = t.zeros_like(self.k)
+        self.ref_counts = [0] * num_blocks
+        self.free_blocks = list(range(num_blocks))[::-1]
+        self.peak_used_blocks = 0
+
+    @property
+    def num_used_blocks(self) -> int:
+        return self.num_blocks - len(self.free_blocks)
+
+    @property
+    def bytes_per_block(self) -> int:
+        return 2 * self.k[:, : self.block_size].nbytes
+
+    def allocate(self) -> int:
+        if not self.free_blocks:
+            raise RuntimeError(f"All {self.num_blocks} KV cache blocks are in use")
+        block = self.free_blocks.pop()
+        self.ref_counts[block] = 1
+        self.peak_used_blocks = max(self.peak_used_blocks, self.num_used_blocks)
+        return block
+
+    def incref(self, block: int) -> None:
+        self.ref_counts[block] += 1
+
+    def decref(self, block: int) -> None:
+        self.ref_counts[block] -= 1
+        if self.ref_counts[block] == 0:
+            self.free_blocks.append(block)
+
+    def copy_block(self, src: int, dst: int) -> None:
+        """Copies the keys & values of block `src` into block `dst` (for every layer)."""
+        bs = self.block_size
+        self.k[:, dst * bs : (dst + 1) * bs] = self.k[:, src * bs : (src + 1) * bs]
+        self.v[:, dst * bs : (dst + 1) * bs] = self.v[:, src * bs : (src + 1) * bs]
+
+
+class PagedKeyValueCacheEntry:
+    """A single layer's view of a `PagedKeyValueCache` (used by `Attention` in the same way as `KeyValueCacheEntry`)."""
+
+    def __init__(self, cache: "PagedKeyValueCache", layer: int):
+        self.cache = cache
+        self.layer = layer
+
+    def update(
+        self,
+        k: Float[Tensor, "batch posn nheads d_head"],
+        v: Float[Tensor, "batch posn nheads d_head"],
+    ) -> tuple[
+        Float[Tensor, "batch posn_K nheads d_head"], Float[Tensor, "batch posn_K nheads d_head"]
+    ]:
+        return self.cache.update(self.layer, k, v)
+
+
+class PagedKeyValueCache:
+    """
+    Drop-in replacement for `KeyValueCache` which keeps keys & values in blocks from a `BlockPool`, rather than in
+    contiguous tensors per layer. Memory is only allocated a block at a time as sequences grow, and freed blocks are
+    reused by other sequences.
+
+    Each row of the batch has a block table (the pool blocks holding its positions, in order). `select` shares blocks
+    between rows instead of copying them, and a shared block is only copied when a row needs to write into it
+    (copy-on-write). Since blocks are only ever appended to, full blocks (e.g. the prompt) stay shared.
+    """
+
+    def __init__(
+        self,
+        pool: BlockPool,
+        batch: int = 1,
+        block_tables: list[list[int]] | None = None,
+        seq_len: int = 0,
+    ):
+        self.pool = pool
+        self.cfg = pool.cfg
+        self.block_tables = block_tables if block_tables is not None else [[] for _ in range(batch)]
+        self._seq_len = seq_len
+        # Slot of each position in each row, recomputed whenever the block tables change
+        self._slots: Int[Tensor, "batch posn"] | None = None
+
+    def __getitem__(self, layer: int) -> PagedKeyValueCacheEntry:
+        # Entries are made on demand (rather than stored) so that they don't form a reference cycle with the cache,
+        # which would stop its blocks being freed as soon as it's no longer used
+        return PagedKeyValueCacheEntry(self, layer)
+
+    def __len__(self) -> int:
+        return self.cfg.n_layers
+
+    def __del__(self):
+        self.free()
+
+    @property
+    def seq_len(self) -> int:
+        """Number of positions currently held in the cache."""
+        return self._seq_len
+
+    def update(
+        self,
+        layer: int,
+        k: Float[Tensor, "batch posn nheads d_head"],
+        v: Float[Tensor, "batch posn nheads d_head"],
+    ) -> tuple[
+        Float[Tensor, "batch posn_K nheads d_head"], Float[Tensor, "batch posn_K nheads d_head"]
+    ]:
+        """
+        Writes the keys and values for the new positions into their slots, and returns the keys and values for all
+        positions so far (gathered from the pool). The first layer's update allocates the slots for all layers.
+        """
+        n_new = k.size(1)
+        if layer == 0:
+            self.append_slots(n_new)
+        slots = self.slots()
+        self.pool.k[layer][slots[:, -n_new:]] = k
+        self.pool.v[layer][slots[:, -n_new:]] = v
+        return self.pool.k[layer][slots], self.pool.v[layer][slots]
+
+    def append_slots(self, n_new: int) -> None:
+        """Makes room for `n_new` more positions in every row, allocating blocks (and copying shared ones) as needed."""
+        bs = self.pool.block_size
+        for table in self.block_tables:
+            # If we're about to write into a block which is shared with other rows, make our own copy of it first
+            if self._seq_len % bs != 0 and self.pool.ref_counts[table[-1]] > 1:
+                block = self.pool.allocate()
+                self.pool.copy_block(table[-1], block)
+                self.pool.decref(table[-1])
+                table[-1] = block
+            while len(table) * bs < self._seq_len + n_new:
+                table.append(self.pool.allocate())
+        self._seq_len += n_new
+        self._slots = None
+
+    def slots(self) -> Int[Tensor, "batch posn"]:
+        if self._slots is None:
+            bs = self.pool.block_size
+            block_tables = t.tensor(self.block_tables, dtype=t.long, device=self.pool.k.device)
+            positions = t.arange(self._seq_len, device=self.pool.k.device)
+            self._slots = block_tables[:, positions // bs] * bs + positions % bs
+        return self._slots
+
+    def select(self, indices: Int[Tensor, "new_batch"]) -> "PagedKeyValueCache":
+        """
+        Returns a new cache made of the given batch rows of this one, sharing their blocks (e.g. to follow beams as
+        they're reordered, duplicated or dropped during beam search). This cache is left unchanged.
+        """
+        block_tables = [list(self.block_tables[i]) for i in t.as_tensor(indices).tolist()]
+        for table in block_tables:
+            for block in table:
+                self.pool.incref(block)
+        return PagedKeyValueCache(self.pool, block_tables=block_tables, seq_len=self._seq_len)
+
+    def truncate(self, seq_len: int) -> None:
+        """Drops every position after the first `seq_len`, freeing any blocks which are no longer needed."""
+        n_blocks = -(-seq_len // self.pool.block_size)
+        for table in self.block_tables:
+            for block in table[n_blocks:]:
+                self.pool.decref(block)
+            del table[n_blocks:]
+        self._seq_len = min(self._seq_len, seq_len)
+        self._slots = None
+
+    def free(self) -> None:
+        """Returns all of this cache's blocks to the pool."""
+        self.truncate(0)
+
+
+# %%
+
+
+def flash_attention(
+    q: Float[Tensor, "batch nheads posn_Q d_head"],
+    k: Float[Tensor, "batch nheads posn_K d_head"],
+    v: Float[Tensor, "batch nheads posn_K d_head"],
+    block_size: int = 128,
+    attention_mask: Bool[Tensor, "batch posn_K"] | None = None,
+    segment_ids: Int[Tensor, "batch posn_K"] | None = None,
+) -> Float[Tensor, "batch nheads posn_Q d_head"]:
+    """
+    Causal attention computed over blocks of queries and keys, in the style of FlashAttention (see
+    `projects/transformer/flash-attention.ipynb`). For each query block we keep a running max & sum of the
+    exponentiated scores (the "online softmax"), rescaling the partial output whenever the max increases, so only a
+    (block_size, block_size) tile of scores exists at any time: peak memory is O(seq * block_size) rather than O(seq²).
+
+    Queries are the last `posn_Q` positions (like `Attention.causal_mask`), and key blocks entirely in the future of a
+    query block are skipped, so no (posn_Q, posn_K) mask is ever built. If `attention_mask` is given, padding keys are
+    masked too (but every position can attend to itself), and if `segment_ids` is given, so are keys from other
+    segments (see `Attention.causal_mask`).
+
+    Note that under autograd, the per-block intermediates are kept for the backward pass, so the memory saving only
+    applies to inference.
+    """
+    n_query, n_key = q.size(-2), k.size(-2)
+    query_offset = n_key - n_query
+    q = q * q.size(-1) ** -0.5
+    out_blocks = []
+
+    for q_start in range(0, n_query, block_size):
+        q_block = q[..., q_start : q_start + block_size, :]
+        first_q, last_q = q_start + query_offset, q_start + query_offset + q_block.size(-2) - 1
+        q_pos = t.arange(first_q, last_q + 1, device=q.device)
+        running_max = t.full(
+            q_block.shape[:-1] + (1,), float("-inf"), device=q.device, dtype=q.dtype
+        )
+        running_sum = t.zeros_like(running_max)
+        acc = t.zeros_like(q_block)
+
+        # Keys after the last query in this block are masked for every query, so we don't visit them
+        for k_start in range(0, last_q + 1, block_size):
+            k_block = k[..., k_start : k_start + block_size, :]
+            v_block = v[..., k_start : k_start + block_size, :]
+            scores = q_block @ k_block.transpose(-1, -2)
+
+            # Only blocks which cross the diagonal (or have padding or segments) need masking
+            k_pos = t.arange(k_start, k_start + k_block.size(-2), device=q.device)
+            mask = None
+            if k_start + k_block.size(-2) - 1 > first_q:
+                mask = k_pos[None, :] > q_pos[:, None]
+            if attention_mask is not None:
+                is_padding = ~attention_mask[:, None, None, k_start : k_start + block_size]
+                padding_mask = is_padding & (k_pos[None, :] != q_pos[:, None])
+                mask = padding_mask if mask is None else mask | padding_mask
+            if segment_ids is not None:
+                q_segments = segment_ids[:, None, first_q : last_q + 1, None]
+                k_segments = segment_ids[:, None, None, k_start : k_start + block_size]
+                mask = (
+                    q_segments != k_segments if mask is None else mask | (q_segments != k_segments)
+                )
+            if mask is not None:
+                scores = scores.masked_fill(mask, float("-inf"))
+
+            # Online softmax: rescale the running sum & output to the new max before adding this block's contribution.
+            # Rows with no unmasked keys yet have max -inf, so we use 0 there to avoid (-inf) - (-inf) = nan.
+            new_max = t.maximum(running_max, scores.amax(-1, keepdim=True))
+            safe_max = new_max.masked_fill(new_max.isinf(), 0.0)
+            probs = (scores - safe_max).exp()
+            correction = (running_max - safe_max).exp()
+            running_sum = running_sum * correction + probs.sum(-1, keepdim=True)
+            acc = acc * correction + probs @ v_block
+            running_max = new_max
+
+        out_blocks.append(acc / running_sum)
+
+    return t.cat(out_blocks, dim=-2)
+
+
+# %%
+
+
 class Attention(nn.Module):
     IGNORE: Float[Tensor, ""]
+    mask: Bool[Tensor, "n_ctx n_ctx"]
 
     def __init__(self, cfg: Config):
         super().__init__()
@@ -352,10 +766,25 @@ class Attention(nn.Module):
         nn.init.normal_(self.W_V, std=self.cfg.init_range)
         nn.init.normal_(self.W_O, std=self.cfg.init_range)
         self.register_buffer("IGNORE", t.tensor(float("-inf"), dtype=t.float32, device=device))
+        # Causal mask for the whole context (True above the diagonal), which `causal_mask` slices. It's not persistent,
+        # so it isn't part of the state dict.
+        self.register_buffer(
+            "mask",
+            t.triu(t.ones(cfg.n_ctx, cfg.n_ctx, dtype=t.bool, device=device), diagonal=1),
+            persistent=False,
+        )
+        self._packed_qkv = None
 
     def forward(
-        self, normalized_resid_pre: Float[Tensor, "batch posn d_model"]
+        self,
+        normalized_resid_pre: Float[Tensor, "batch posn d_model"],
+        kv_cache: KeyValueCacheEntry | None = None,
+        attention_mask: Bool[Tensor, "batch posn_K"] | None = None,
+        segment_ids: Int[Tensor, "batch posn_K"] | None = None,
     ) -> Float[Tensor, "batch posn d_model"]:
+        if self.cfg.attn_impl in ("sdpa", "flash"):
+            return self.forward_sdpa(normalized_resid_pre, kv_cache, attention_mask, segment_ids)
+
         # Calculate query, key and value vectors
         q = (
             einops.einsum(
@@ -382,13 +811,19 @@ class Attention(nn.Module):
             + self.b_V
         )
 
+        # Prepend the keys and values of earlier positions, if they're cached (queries are only for the new positions)
+        if kv_cache is not None:
+            k, v = kv_cache.update(k, v)
+
         # Calculate attention scores, then scale and mask, and apply softmax to get probabilities
         attn_scores = einops.einsum(
             q,
             k,
             "batch posn_Q nheads d_head, batch posn_K nheads d_head -> batch nheads posn_Q posn_K",
         )
-        attn_scores_masked = self.apply_causal_mask(attn_scores / self.cfg.d_head**0.5)
+        attn_scores_masked = self.apply_causal_mask(
+            attn_scores / self.cfg.d_head**0.5, attention_mask, segment_ids
+        )
         attn_pattern = attn_scores_masked.softmax(-1)
 
         # Take weighted sum of value vectors, according to attention probabilities
@@ -410,15 +845,157 @@ class Attention(nn.Module):
 
         return attn_out
 
+    def forward_sdpa(
+        self,
+        normalized_resid_pre: Float[Tensor, "batch posn d_model"],
+        kv_cache: KeyValueCacheEntry | None = None,
+        attention_mask: Bool[Tensor, "batch posn_K"] | None = None,
+        segment_ids: Int[Tensor, "batch posn_K"] | None = None,
+    ) -> Float[Tensor, "batch posn d_model"]:
+        """
+        Fast path for `forward` (used when `cfg.attn_impl == "sdpa"`). Queries, keys and values come from a single
+        packed projection, and PyTorch's fused `scaled_dot_product_attention` is used instead of materializing the
+        attention scores & pattern. The einsum implementation in `forward` is the reference this should match.
+
+        With `cfg.attn_impl == "flash"`, our own tiled `flash_attention` is used in place of the PyTorch kernel.
+        """
+        W_QKV, b_QKV = self.packed_qkv()
+        qkv = normalized_resid_pre @ W_QKV + b_QKV
+        q, k, v = einops.rearrange(
+            qkv,
+            "batch posn (qkv nheads d_head) -> qkv batch posn nheads d_head",
+            qkv=3,
+            nheads=self.cfg.n_heads,
+        )
+
+        if kv_cache is not None:
+            k, v = kv_cache.update(k, v)
+
+        if self.cfg.attn_impl == "flash":
+            z = flash_attention(
+                q.transpose(1, 2),
+                k.transpose(1, 2),
+                v.transpose(1, 2),
+                block_size=self.cfg.attn_block_size,
+                attention_mask=attention_mask,
+                segment_ids=segment_ids,
+            )
+            return (
+                einops.einsum(
+                    z,
+                    self.W_O,
+                    "batch nheads posn_Q d_head, nheads d_head d_model -> batch posn_Q d_model",
+                )
+                + self.b_O
+            )
+
+        # `is_causal` assumes queries and keys start at the same position, so we need an explicit mask when there are
+        # cached keys (unless there's only one query, which can attend to everything), padding or segments
+        attn_mask, is_causal = None, False
+        if attention_mask is not None or segment_ids is not None or 1 < q.size(1) < k.size(1):
+            attn_mask = ~self.causal_mask(q.size(1), k.size(1), attention_mask, segment_ids)
+        elif q.size(1) > 1:
+            is_causal = True
+        z = F.scaled_dot_product_attention(
+            q.transpose(1, 2),
+            k.transpose(1, 2),
+            v.transpose(1, 2),
+            attn_mask=attn_mask,
+            is_causal=is_causal,
+        )
+
+        attn_out = (
+            einops.einsum(
+                z,
+                self.W_O,
+                "batch nheads posn_Q d_head, nheads d_head d_model -> batch posn_Q d_model",
+            )
+            + self.b_O
+        )
+
+        return attn_out
+
+    def packed_qkv(
+        self,
+    ) -> tuple[Float[Tensor, "d_model qkv_nheads_d_head"], Float[Tensor, "qkv_nheads_d_head"]]:
+        """
+        Returns W_Q, W_K & W_V packed into a single (d_model, 3 * n_heads * d_head) matrix, and the matching bias.
+
+        When we're not tracking gradients, the packed tensors are cached until one of the parameters changes (e.g. after
+        an optimizer step), so decoding doesn't pay for repacking the weights every step.
+        """
+        params = (self.W_Q, self.W_K, self.W_V, self.b_Q, self.b_K, self.b_V)
+        track_grads = t.is_grad_enabled() and any(p.requires_grad for p in params)
+        # Parameters created under `t.inference_mode()` have no version counter, so we can't tell if they've changed.
+        # Inside `torch.compile` we just repack, since the version check can't be traced.
+        cacheable = (
+            not track_grads
+            and not t.compiler.is_compiling()
+            and not any(p.is_inference() for p in params)
+        )
+        key = tuple((p.data_ptr(), p._version) for p in params) if cacheable else None
+        if cacheable and self._packed_qkv is not None and self._packed_qkv[0] == key:
+            return self._packed_qkv[1]
+
+        W_QKV = einops.rearrange(
+            t.stack(params[:3]), "qkv nheads d_model d_head -> d_model (qkv nheads d_head)"
+        )
+        b_QKV = t.stack(params[3:]).flatten()
+        if cacheable:
+            self._packed_qkv = (key, (W_QKV, b_QKV))
+        return W_QKV, b_QKV
+
+    def causal_mask(
+        self,
+        n_query: int,
+        n_key: int,
+        attention_mask: Bool[Tensor, "batch key_pos"] | None = None,
+        segment_ids: Int[Tensor, "batch key_pos"] | None = None,
+    ) -> Bool[Tensor, "*batch 1 query_pos key_pos"]:
+        """
+        Returns a mask which is True for all (query, key) pairs whose attention probability should be zero.
+
+        If there are fewer queries than keys (i.e. earlier keys came from a cache), the queries are the last positions.
+        If `attention_mask` is given, keys where it's False (i.e. padding) are also masked. If `segment_ids` is given
+        (for sequences packed from several documents), keys in a different segment to the query are masked too, which
+        makes the mask block-diagonal.
+        """
+        query_offset = n_key - n_query
+        if n_key <= self.mask.size(-1):
+            # Rows of the precomputed mask are query positions, so cached decoding just takes rows further down
+            mask = self.mask[query_offset:n_key, :n_key]
+        else:
+            all_ones = t.ones(n_query, n_key, device=self.mask.device)
+            mask = t.triu(all_ones, diagonal=query_offset + 1).bool()
+        if attention_mask is not None:
+            # Every position can still attend to itself, so that padding queries don't end up with all-masked rows
+            # (which would give NaNs). Their outputs are never used.
+            query_pos = t.arange(n_query, device=mask.device) + query_offset
+            key_pos = t.arange(n_key, device=mask.device)
+            is_self = query_pos[:, None] == key_pos[None, :]
+            mask = mask | (~attention_mask[:, None, None, :] & ~is_self)
+        if segment_ids is not None:
+            query_segments = segment_ids[:, None, query_offset:, None]
+            mask = mask | (query_segments != segment_ids[:, None, None, :])
+        return mask
+
     def apply_causal_mask(
-        self, attn_scores: Float[Tensor, "batch n_heads query_pos key_pos"]
+        self,
+        attn_scores: Float[Tensor, "batch n_heads query_pos key_pos"],
+        attention_mask: Bool[Tensor, "batch key_pos"] | None = None,
+        segment_ids: Int[Tensor, "batch key_pos"] | None = None,
     ) -> Float[Tensor, "batch n_heads query_pos key_pos"]:
         """
         Applies a causal mask to attention scores, and returns masked scores.
+
+        If there are fewer queries than keys (i.e. earlier keys came from a cache), the queries are the last positions.
+        If `attention_mask` is given, keys where it's False (i.e. padding) are also masked, and if `segment_ids` is
+        given, so are keys from other segments.
         """
         # Define a mask that is True for all positions we want to set probabilities to zero for
-        all_ones = t.ones(attn_scores.size(-2), attn_scores.size(-1), device=attn_scores.device)
-        mask = t.triu(all_ones, diagonal=1).bool()
+        mask = self.causal_mask(
+            attn_scores.size(-2), attn_scores.size(-1), attention_mask, segment_ids
+        )
         # Apply the mask to attention scores, then return the masked scores
         attn_scores.masked_fill_(mask, self.IGNORE)
         return attn_scores
@@ -431,6 +1008,87 @@ if MAIN:
 
 # %%
 
+if MAIN:
+    # The fused SDPA path should match the einsum reference, with and without a KV cache
+    attn_ref = Attention(Config()).to(device)
+    attn_sdpa = Attention(Config(attn_impl="sdpa")).to(device)
+    attn_sdpa.load_state_dict(attn_ref.state_dict())
+    x = t.randn(2, 64, 768, device=device)
+    t.testing.assert_close(attn_sdpa(x), attn_ref(x), atol=1e-4, rtol=1e-4)
+
+    cache_ref, cache_sdpa = KeyValueCacheEntry(), KeyValueCacheEntry()
+    for chunk in x.split([48, 15, 1], dim=1):
+        t.testing.assert_close(
+            attn_sdpa(chunk, cache_sdpa), attn_ref(chunk, cache_ref), atol=1e-4, rtol=1e-4
+        )
+
+    print("Tests passed!")
+
+# %%
+
+if MAIN:
+    # Benchmark a single GPT-2 small attention layer (forward pass only) across sequence lengths
+    attn_ref, attn_sdpa = attn_ref.cpu(), attn_sdpa.cpu()
+    table = Table(
+        "seq_len", "einsum (ms)", "sdpa (ms)", "speedup", title="Attention.forward on CPU"
+    )
+    with t.inference_mode():
+        for seq_len in [128, 256, 512, 1024]:
+            x = t.randn(1, seq_len, 768)
+            time_ref = benchmark(lambda: attn_ref(x))
+            time_sdpa = benchmark(lambda: attn_sdpa(x))
+            table.add_row(
+                str(seq_len),
+                f"{time_ref * 1e3:.2f}",
+                f"{time_sdpa * 1e3:.2f}",
+                f"{time_ref / time_sdpa:.2f}x",
+            )
+    rprint(table)
+
+# %%
+
+if MAIN:
+    # The tiled implementation should also match the reference, including block sizes which don't divide seq_len
+    attn_flash = Attention(Config(attn_impl="flash", attn_block_size=24)).to(device)
+    attn_flash.load_state_dict(attn_ref.state_dict())
+    attn_ref = attn_ref.to(device)
+    x = t.randn(2, 64, 768, device=device)
+    t.testing.assert_close(attn_flash(x), attn_ref(x), atol=1e-4, rtol=1e-4)
+
+    cache_ref, cache_flash = KeyValueCacheEntry(), KeyValueCacheEntry()
+    for chunk in x.split([48, 15, 1], dim=1):
+        t.testing.assert_close(
+            attn_flash(chunk, cache_flash), attn_ref(chunk, cache_ref), atol=1e-4, rtol=1e-4
+        )
+
+    print("Tests passed!")
+
+# %%
+
+if MAIN:
+    # Compare peak memory & wall time of the tiled implementation against the reference, for long sequences (each
+    # config is only run once for memory, since that's what we're measuring)
+    table = Table(
+        "seq_len", "impl", "peak RSS (MB)", "time (ms)", title="Attention.forward on CPU, batch 1"
+    )
+    with t.inference_mode():
+        for seq_len in [1024, 2048, 4096]:
+            cfg_long = Config(n_ctx=seq_len)
+            x = t.randn(1, seq_len, 768)
+            for impl in ["einsum", "flash"]:
+                attn = Attention(replace(cfg_long, attn_impl=impl)).cpu()
+                attn.load_state_dict(attn_ref.state_dict())
+                peak_mb = peak_rss_mb(lambda: attn(x))
+                table.add_row(
+                    str(seq_len),
+                    impl,
+                    f"{peak_mb:.0f}",
+                    f"{benchmark(lambda: attn(x), n_iters=3) * 1e3:.0f}",
+                )
+    rprint(table)
+
+# %%
+
 
 class MLP(nn.Module):
     def __init__(self, cfg: Config):
@@ -481,9 +1139,15 @@ class TransformerBlock(nn.Module):
         self.mlp = MLP(cfg)
 
     def forward(
-        self, resid_pre: Float[Tensor, "batch position d_model"]
+        self,
+        resid_pre: Float[Tensor, "batch position d_model"],
+        kv_cache: KeyValueCacheEntry | None = None,
+        attention_mask: Bool[Tensor, "batch posn_K"] | None = None,
+        segment_ids: Int[Tensor, "batch posn_K"] | None = None,
     ) -> Float[Tensor, "batch position d_model"]:
-        resid_mid = self.attn(self.ln1(resid_pre)) + resid_pre
+        resid_mid = (
+            self.attn(self.ln1(resid_pre), kv_cache, attention_mask, segment_ids) + resid_pre
+        )
         resid_post = self.mlp(self.ln2(resid_mid)) + resid_mid
         return resid_post
 
@@ -534,13 +1198,79 @@ class DemoTransformer(nn.Module):
         self.unembed = Unembed(cfg)
 
     def forward(
-        self, tokens: Int[Tensor, "batch position"]
+        self,
+        tokens: Int[Tensor, "batch position"],
+        kv_cache: KeyValueCache | None = None,
+        attention_mask: Bool[Tensor, "batch posn_K"] | None = None,
+        segment_ids: Int[Tensor, "batch position"] | None = None,
     ) -> Float[Tensor, "batch position d_vocab"]:
-        residual = self.embed(tokens) + self.pos_embed(tokens)
-        for block in self.blocks:
-            residual = block(residual)
-        logits = self.unembed(self.ln_final(residual))
-        return logits
+        return self.unembed(
+            self.normalized_resid_final(tokens, kv_cache, attention_mask, segment_ids)
+        )
+
+    def normalized_resid_final(
+        self,
+        tokens: Int[Tensor, "batch position"],
+        kv_cache: KeyValueCache | None = None,
+        attention_mask: Bool[Tensor, "batch posn_K"] | None = None,
+        segment_ids: Int[Tensor, "batch position"] | None = None,
+    ) -> Float[Tensor, "batch position d_model"]:
+        """
+        Runs everything up to the unembedding, returning the final layer-normed residual stream. `forward` applies
+        `unembed` to this, but it can also be unembedded a chunk of positions at a time, so the full logits never exist.
+
+        If `kv_cache` is given, `tokens` are the positions following the ones already in the cache, and the cache is
+        updated in place with their keys and values.
+
+        If `attention_mask` is given, it's False for padding tokens, and covers the cached positions as well as
+        `tokens`. Padding is masked out of attention and doesn't count towards the position of later tokens.
+
+        If `segment_ids` is given, each row packs several documents, with the segment id of each token saying which one
+        it belongs to (segments must be contiguous). Tokens only attend within their own segment, and positions restart
+        from 0 at the start of each segment, so every document is processed as if it were on its own.
+        """
+        offset = 0 if kv_cache is None else kv_cache.seq_len
+        position_ids = None
+        if attention_mask is not None:
+            position_ids = (attention_mask.cumsum(-1) - 1).clamp(min=0)[:, -tokens.size(1) :]
+        if segment_ids is not None:
+            assert kv_cache is None, "Packed segments aren't supported with a KV cache"
+            positions = t.arange(tokens.size(1), device=tokens.device).expand_as(segment_ids)
+            is_start = F.pad(segment_ids[:, 1:] != segment_ids[:, :-1], (1, 0), value=True)
+            position_ids = positions - t.where(is_start, positions, 0).cummax(-1).values
+        residual = self.embed_tokens(tokens, offset, position_ids)
+        for i, block in enumerate(self.blocks):
+            if (
+                i < self.cfg.checkpoint_blocks
+                and self.training
+                and t.is_grad_enabled()
+                and kv_cache is None
+            ):
+                residual = t.utils.checkpoint.checkpoint(
+                    block, residual, None, attention_mask, segment_ids, use_reentrant=False
+                )
+            else:
+                residual = block(
+                    residual,
+                    None if kv_cache is None else kv_cache[i],
+                    attention_mask,
+                    segment_ids,
+                )
+        return self.ln_final(residual)
+
+    def embed_tokens(
+        self,
+        tokens: Int[Tensor, "batch position"],
+        offset: int = 0,
+        position_ids: Int[Tensor, "batch position"] | None = None,
+    ) -> Float[Tensor, "batch position d_model"]:
+        """
+        Returns the token plus positional embeddings (see `PosEmbed.forward` for `offset` & `position_ids`). The
+        positional embeddings are added in place to the gathered token embeddings, so this allocates one tensor.
+        """
+        residual = self.embed(tokens)
+        residual += self.pos_embed(tokens, offset, position_ids)
+        return residual
 
 
 if MAIN:
@@ -557,11 +1287,87 @@ if MAIN:
 
 # %%
 
+if MAIN:
+    # Compare slicing the precomputed mask against building it with `triu` every call, and the resulting forward pass
+    # latency of GPT-2 small at batch 1 (the old cost is n_layers mask builds per forward pass)
+    gpt2_cpu = DemoTransformer(Config()).cpu()
+    attn = gpt2_cpu.blocks[0].attn
+    table = Table(
+        "seq_len",
+        "triu mask (us)",
+        "sliced mask (us)",
+        "forward (ms)",
+        title="Causal mask, batch 1",
+    )
+    with t.inference_mode():
+        for seq_len in [16, 128, 1024]:
+            time_triu = benchmark(
+                lambda: t.triu(t.ones(seq_len, seq_len), diagonal=1).bool(), n_iters=100
+            )
+            time_sliced = benchmark(lambda: attn.causal_mask(seq_len, seq_len), n_iters=100)
+            bench_tokens = t.randint(0, 50257, (1, seq_len))
+            time_forward = benchmark(lambda: gpt2_cpu(bench_tokens), n_iters=5)
+            table.add_row(
+                str(seq_len),
+                f"{time_triu * 1e6:.1f}",
+                f"{time_sliced * 1e6:.1f}",
+                f"{time_forward * 1e3:.1f}",
+            )
+    rprint(table)
+
+# %%
+
+if MAIN:
+    # Packing several documents into one sequence with segment ids should give the same logits as running each one
+    # separately, i.e. nothing leaks across document boundaries
+    docs = [
+        reference_gpt2.to_tokens(text)[0]
+        for text in ["Hello world", "The cat sat on the mat.", reference_text[:200]]
+    ]
+    packed_tokens = t.cat(docs)[None]
+    segment_ids = t.cat([t.full_like(doc, i) for i, doc in enumerate(docs)])[None]
+    with t.inference_mode():
+        packed_logits = demo_gpt2(packed_tokens, segment_ids=segment_ids)
+        separate_logits = t.cat([demo_gpt2(doc[None]) for doc in docs], dim=1)
+    t.testing.assert_close(packed_logits, separate_logits, atol=1e-4, rtol=1e-4)
+
+# %%
+
+if MAIN:
+    # Profile the memory allocated by the embedding stage at batch 64, compared to repeating the positional embeddings
+    # over the batch and then adding them to the token embeddings (as we did before `embed_tokens`)
+    def embed_tokens_with_repeat(model: DemoTransformer, tokens: Int[Tensor, "batch position"]):
+        pos = einops.repeat(
+            model.pos_embed.W_pos[: tokens.size(1)],
+            "seq d_model -> batch seq d_model",
+            batch=len(tokens),
+        )
+        return model.embed(tokens) + pos
+
+    batch_tokens = t.randint(0, demo_gpt2.cfg.d_vocab, (64, demo_gpt2.cfg.n_ctx), device=device)
+    for name, embed_fn in [
+        ("repeat + add", lambda: embed_tokens_with_repeat(demo_gpt2, batch_tokens)),
+        ("broadcast + in-place add", lambda: demo_gpt2.embed_tokens(batch_tokens)),
+    ]:
+        with t.inference_mode(), t.profiler.profile(profile_memory=True) as prof:
+            embed_fn()
+        allocated = sum(max(event.self_cpu_memory_usage, 0) for event in prof.key_averages())
+        if device.type == "cuda":
+            allocated = sum(max(event.self_device_memory_usage, 0) for event in prof.key_averages())
+        print(f"{name}: {allocated / 2**20:.0f} MB allocated")
+
+    t.testing.assert_close(
+        demo_gpt2.embed_tokens(batch_tokens), embed_tokens_with_repeat(demo_gpt2, batch_tokens)
+    )
+
+# %%
+
 
 def get_log_probs(
     logits: Float[Tensor, "batch posn d_vocab"], tokens: Int[Tensor, "batch posn"]
 ) -> Float[Tensor, "batch posn-1"]:
-    log_probs = logits.log_softmax(dim=-1)
+    # Under mixed precision the logits are bf16 / fp16, but the log-softmax needs fp32 to be accurate
+    log_probs = logits.float().log_softmax(dim=-1)
     # Get logprobs the first seq_len-1 predictions (so we can compare them with the actual next tokens)
     log_probs_for_tokens = (
         log_probs[:, :-1].gather(dim=-1, index=tokens[:, 1:].unsqueeze(-1)).squeeze(-1)
@@ -578,6 +1384,151 @@ if MAIN:
 
 # %%
 
+
+@t.inference_mode()
+def evaluate_tokens(
+    model: DemoTransformer,
+    batches: Iterable[dict[str, Int[Tensor, "batch seq"]]],
+    chunk_size: int = 1024,
+    autocast: Callable[[], ContextManager] = contextlib.nullcontext,
+) -> dict[str, float]:
+    """
+    Returns the loss (mean cross entropy), perplexity and accuracy of the model's next-token predictions on `batches`
+    (dicts with "tokens", and optionally "segment_ids").
+
+    The unembedding is applied to `chunk_size` positions (across the whole batch) at a time, so only a
+    (chunk_size, d_vocab) slice of the logits exists at once. Totals are accumulated on the device, and only copied to
+    the host (which waits for all the queued work to finish) once at the end, rather than once per batch.
+    """
+    total_loss = t.zeros((), dtype=t.float64, device=device)
+    total_correct = t.zeros((), dtype=t.int64, device=device)
+    n_predictions = 0
+
+    for batch in batches:
+        tokens = batch["tokens"].to(device, non_blocking=True)
+        segment_ids = batch.get("segment_ids")
+        if segment_ids is not None:
+            segment_ids = segment_ids.to(device, non_blocking=True)
+        with autocast():
+            resid = model.normalized_resid_final(tokens, segment_ids=segment_ids)
+        resid, targets = resid[:, :-1].flatten(0, 1), tokens[:, 1:].flatten()
+        for resid_chunk, target_chunk in zip(resid.split(chunk_size), targets.split(chunk_size)):
+            with autocast():
+                logits = model.unembed(resid_chunk[None])[0]
+            # Cross entropy is logsumexp(logits) - logits[target], which avoids a full log-softmax output
+            logits = logits.float()
+            target_logits = logits.gather(-1, target_chunk[:, None])[:, 0]
+            total_loss += (logits.logsumexp(-1) - target_logits).sum()
+            total_correct += (logits.argmax(-1) == target_chunk).sum()
+        n_predictions += targets.numel()
+
+    total_loss, total_correct = t.stack([total_loss, total_correct.double()]).tolist()
+    loss = total_loss / n_predictions
+    return {"loss": loss, "perplexity": math.exp(loss), "accuracy": total_correct / n_predictions}
+
+
+if MAIN:
+    metrics = evaluate_tokens(demo_gpt2, [{"tokens": tokens}], chunk_size=16)
+    t.testing.assert_close(metrics["loss"], -pred_log_probs.mean().item(), atol=1e-4, rtol=1e-4)
+    print(metrics)
+
+# %%
+
+
+class ChunkedCrossEntropy(t.autograd.Function):
+    """
+    Unembedding followed by cross entropy, computed `chunk_size` positions at a time so that only a
+    (chunk_size, d_vocab) slice of the logits ever exists. The forward pass only keeps the logsumexp of each position's
+    logits, and the backward pass recomputes each chunk's logits to get its gradients, rather than storing them all.
+    """
+
+    @staticmethod
+    @t.amp.custom_fwd(device_type=device.type)
+    def forward(
+        ctx,
+        resid: Float[Tensor, "n d_model"],
+        W_U: Float[Tensor, "d_model d_vocab"],
+        b_U: Float[Tensor, "d_vocab"],
+        targets: Int[Tensor, "n"],
+        chunk_size: int,
+    ) -> Float[Tensor, "n"]:
+        losses = t.empty(len(resid), dtype=t.float32, device=resid.device)
+        logsumexp = t.empty_like(losses)
+        for start in range(0, len(resid), chunk_size):
+            end = start + chunk_size
+            logits = (resid[start:end] @ W_U + b_U).float()
+            logsumexp[start:end] = logits.logsumexp(-1)
+            target_logits = logits.gather(-1, targets[start:end, None])[:, 0]
+            losses[start:end] = logsumexp[start:end] - target_logits
+        ctx.save_for_backward(resid, W_U, b_U, targets, logsumexp)
+        ctx.chunk_size = chunk_size
+        return losses
+
+    @staticmethod
+    @t.amp.custom_bwd(device_type=device.type)
+    def backward(ctx, grad_losses: Float[Tensor, "n"]):
+        resid, W_U, b_U, targets, logsumexp = ctx.saved_tensors
+        grad_resid = t.empty_like(resid) if ctx.needs_input_grad[0] else None
+        grad_W_U = t.zeros_like(W_U) if ctx.needs_input_grad[1] else None
+        grad_b_U = t.zeros_like(b_U) if ctx.needs_input_grad[2] else None
+        for start in range(0, len(resid), ctx.chunk_size):
+            end = start + ctx.chunk_size
+            # The gradient of the loss wrt the logits is softmax(logits) - one_hot(target)
+            logits = (resid[start:end] @ W_U + b_U).float()
+            grad_logits = logits.sub_(logsumexp[start:end, None]).exp_()
+            grad_logits[
+                t.arange(len(grad_logits), device=grad_logits.device), targets[start:end]
+            ] -= 1
+            grad_logits = (grad_logits * grad_losses[start:end, None]).to(resid.dtype)
+            if grad_resid is not None:
+                grad_resid[start:end] = grad_logits @ W_U.T
+            if grad_W_U is not None:
+                grad_W_U += resid[start:end].T @ grad_logits
+            if grad_b_U is not None:
+                grad_b_U += grad_logits.sum(0)
+        return grad_resid, grad_W_U, grad_b_U, None, None
+
+
+def chunked_cross_entropy(
+    normalized_resid_final: Float[Tensor, "batch posn d_model"],
+    unembed: Unembed,
+    targets: Int[Tensor, "batch posn"],
+    chunk_size: int = 1024,
+) -> Float[Tensor, "batch posn"]:
+    """
+    Returns the cross entropy loss of predicting `targets` from the final residual stream at each position, i.e.
+    `-get_log_probs(unembed(resid), tokens)` when `targets` are the next tokens, but without materializing the logits
+    for all positions (see `ChunkedCrossEntropy`). Chunks are of `chunk_size` positions, across the whole batch.
+    """
+    losses = ChunkedCrossEntropy.apply(
+        normalized_resid_final.flatten(0, 1),
+        unembed.W_U,
+        unembed.b_U,
+        targets.flatten(),
+        chunk_size,
+    )
+    return losses.view(targets.shape)
+
+
+if MAIN:
+    # The chunked loss & its gradients should match computing the full logits
+    resid = t.randn(2, 64, 768, device=device, requires_grad=True)
+    resid_ref = resid.detach().clone().requires_grad_()
+    targets = t.randint(0, demo_gpt2.cfg.d_vocab, (2, 64), device=device)
+    loss = chunked_cross_entropy(resid, demo_gpt2.unembed, targets, chunk_size=24).mean()
+    loss.backward()
+    grad_W_U = demo_gpt2.unembed.W_U.grad.clone()
+    demo_gpt2.zero_grad()
+    logits = demo_gpt2.unembed(resid_ref)
+    loss_ref = -logits.log_softmax(-1).gather(-1, targets[..., None]).mean()
+    loss_ref.backward()
+    t.testing.assert_close(loss, loss_ref)
+    t.testing.assert_close(resid.grad, resid_ref.grad)
+    t.testing.assert_close(grad_W_U, demo_gpt2.unembed.W_U.grad)
+    demo_gpt2.zero_grad()
+
+# %%
+
 if MAIN:
     test_string = """Mitigating the risk of extinction from AI should be a global priority alongside other societal-scale risks such as"""
     for i in tqdm(range(100)):
@@ -614,51 +1565,61 @@ class TransformerTrainingArgs:
     weight_decay: float = 1e-2
     wandb_project: str | None = "day1-demotransformer"
     wandb_name: str | None = None
+    # Run the forward pass under autocast in "bf16" or "fp16" (fp16 also scales the loss to avoid gradient underflow).
+    # Parameters, optimizer state, layer norms and the loss stay in fp32.
+    mixed_precision: str | None = None
+    # Split each batch into this many micro-batches, and accumulate their gradients before stepping the optimizer. The
+    # effective batch size is still `batch_size`, but activations are only held for one micro-batch at a time.
+    grad_accum_steps: int = 1
+    # Compute the loss from the final residual stream this many positions at a time (with `chunked_cross_entropy`),
+    # rather than from the full logits, so their (batch, seq, d_vocab) tensor never exists
+    loss_chunk_size: int | None = None
+    # Evaluate after each epoch on this many test sequences (a fixed random subset), rather than the whole test set
+    eval_subset_size: int | None = None
 
+    def __post_init__(self):
+        assert (
+            1 <= self.grad_accum_steps <= self.batch_size
+        ), "Need 1 <= grad_accum_steps <= batch_size"
+        assert self.mixed_precision in (
+            None,
+            "bf16",
+            "fp16",
+        ), f"Unknown mixed precision mode {self.mixed_precision!r}"
 
-if MAIN:
-    args = TransformerTrainingArgs()
-
-# %%
 
 if MAIN:
-    dataset = datasets.load_dataset("roneneldan/TinyStories", split="train")
-    print(dataset)
-    print(dataset[0]["text"])
+    args = TransformerTrainingArgs()
 
 # %%
 
 if MAIN:
-    tokenized_dataset = tokenize_and_concatenate(
-        dataset,
-        reference_gpt2.tokenizer,
-        streaming=False,
-        max_length=model.cfg.n_ctx,
-        column_name="text",
-        add_bos_token=True,
-        num_proc=4,
-    )
-
-    dataset_dict = tokenized_dataset.train_test_split(test_size=1000)
-    train_loader = DataLoader(
-        dataset_dict["train"],
-        batch_size=args.batch_size,
-        shuffle=True,
-        num_workers=4,
-        pin_memory=True,
-    )
-    test_loader = DataLoader(
-        dataset_dict["test"],
-        batch_size=args.batch_size,
-        shuffle=False,
-        num_workers=4,
-        pin_memory=True,
-    )
+    # Tokenize TinyStories once into flat token files (this is slow, but only happens on the first run, and can also be
+    # done with `python -m silen_lib.transformers.data`). After that, opening the datasets just memory-maps the files.
+    data_path = Path("data/tinystories")
+    for split in ["train", "validation"]:
+        if not token_bin_exists(f"{data_path}-{split}"):
+            dataset = datasets.load_dataset("roneneldan/TinyStories", split=split)
+            write_token_bin(dataset["text"], reference_gpt2.tokenizer, f"{data_path}-{split}")
+
+    start = time.perf_counter()
+    train_dataset, validation_dataset = [
+        MemmapTokenDataset(
+            f"{data_path}-{split}",
+            n_ctx=model.cfg.n_ctx,
+            bos_token_id=reference_gpt2.tokenizer.bos_token_id,
+        )
+        for split in ["train", "validation"]
+    ]
+    # Evaluate on a fixed 1000 windows of the validation split
+    test_dataset = Subset(validation_dataset, range(1000))
+    print(f"Opened {len(train_dataset):,} training windows in {time.perf_counter() - start:.4f}s")
+    print(reference_gpt2.tokenizer.decode(train_dataset[0]["tokens"]))
 
 # %%
 
 if MAIN:
-    first_batch = train_loader.dataset[: args.batch_size]
+    first_batch = train_dataset[: args.batch_size]
 
     print(first_batch.keys())
     print(first_batch["tokens"].shape)
@@ -667,7 +1628,16 @@ if MAIN:
 
 
 class TransformerTrainer:
-    def __init__(self, args: TransformerTrainingArgs, model: DemoTransformer):
+    def __init__(
+        self,
+        args: TransformerTrainingArgs,
+        model: DemoTransformer,
+        train_data: Dataset | IterableDataset | None = None,
+    ):
+        """
+        Trains on `train_data` if it's given, else on `train_dataset`. A `StreamingTokenDataset` is shuffled by the
+        dataset itself, and its cursor is advanced after every step, so `train_data.state_dict()` can resume from it.
+        """
         super().__init__()
         self.model = model
         self.args = args
@@ -676,57 +1646,98 @@ class TransformerTrainer:
             self.model.parameters(), lr=args.lr, weight_decay=args.weight_decay
         )
         self.step = 0
+        self.autocast_dtype = {None: None, "bf16": t.bfloat16, "fp16": t.float16}[
+            args.mixed_precision
+        ]
+        # Only fp16 needs loss scaling, since bf16 has the same exponent range as fp32
+        self.scaler = t.amp.GradScaler(device.type, enabled=args.mixed_precision == "fp16")
 
+        train_data = train_dataset if train_data is None else train_data
         self.train_loader = DataLoader(
-            dataset_dict["train"],
+            train_data,
             batch_size=args.batch_size,
-            shuffle=True,
+            shuffle=not isinstance(train_data, IterableDataset),
             num_workers=4,
             pin_memory=True,
         )
         self.test_loader = DataLoader(
-            dataset_dict["test"],
+            test_dataset,
             batch_size=args.batch_size,
             shuffle=False,
             num_workers=4,
             pin_memory=True,
         )
+        self.test_subset_loaders: dict[int, DataLoader] = {}
 
     def training_step(self, batch: dict[str, Int[Tensor, "batch seq"]]) -> Float[Tensor, ""]:
         """
         Calculates the loss on the tokens in the batch, performs a gradient update step, and logs the loss.
 
-        Remember that `batch` is a dictionary with the single key 'tokens'.
+        Remember that `batch` is a dictionary with the key 'tokens', and also 'segment_ids' if the sequences are packed
+        from several documents (see `MemmapTokenDataset`). The batch is run in `args.grad_accum_steps` micro-batches,
+        whose gradients add up to those of the whole batch.
         """
-        tokens = batch["tokens"].to(device)
-        logits = self.model(tokens)
-        loss = -get_log_probs(logits, tokens).mean()
-        loss.backward()
-        self.optimizer.step()
+        all_tokens = batch["tokens"].to(device)
+        all_segment_ids = [None] * self.args.grad_accum_steps
+        if "segment_ids" in batch:
+            all_segment_ids = batch["segment_ids"].to(device).chunk(self.args.grad_accum_steps)
+        loss = t.zeros((), device=device)
+        for tokens, segment_ids in zip(
+            all_tokens.chunk(self.args.grad_accum_steps), all_segment_ids
+        ):
+            with self.autocast():
+                if self.args.loss_chunk_size is None:
+                    log_probs = get_log_probs(self.model(tokens, segment_ids=segment_ids), tokens)
+                else:
+                    resid = self.model.normalized_resid_final(tokens, segment_ids=segment_ids)
+                    log_probs = -chunked_cross_entropy(
+                        resid[:, :-1], self.model.unembed, tokens[:, 1:], self.args.loss_chunk_size
+                    )
+            # Weight by micro-batch size, so the sum is the mean over the whole batch even if it doesn't split evenly
+            micro_batch_loss = -log_probs.mean() * len(tokens) / len(all_tokens)
+            self.scaler.scale(micro_batch_loss).backward()
+            loss += micro_batch_loss.detach()
+        self.scaler.step(self.optimizer)
+        self.scaler.update()
         self.optimizer.zero_grad()
         self.step += 1
         wandb.log({"train_loss": loss}, step=self.step)
         return loss
 
-    @t.inference_mode()
-    def evaluate(self) -> float:
+    def autocast(self) -> t.autocast:
+        """Context manager for the forward pass, which autocasts to `args.mixed_precision` if it's set."""
+        return t.autocast(
+            device.type, dtype=self.autocast_dtype, enabled=self.autocast_dtype is not None
+        )
+
+    def evaluate(self, subset_size: int | None = None) -> dict[str, float]:
         """
-        Evaluate the model on the test set and return the accuracy.
+        Evaluates the model on the test set, and returns (and logs) the loss, perplexity and accuracy.
+
+        If `subset_size` is given, only that many test sequences are used, chosen at random once (so that the same ones
+        are used every time, and results are comparable between evaluations).
         """
-        self.model.eval()
-        total_correct, total_samples = 0, 0
-
-        for batch in tqdm(self.test_loader, desc="Evaluating"):
-            tokens = batch["tokens"].to(device)
-            logits: Tensor = self.model(tokens)[:, :-1]
-            predicted_tokens = logits.argmax(dim=-1)
-            total_correct += (predicted_tokens == tokens[:, 1:]).sum().item()
-            total_samples += tokens.size(0) * (tokens.size(1) - 1)
+        test_loader = self.test_loader
+        if subset_size is not None:
+            if subset_size not in self.test_subset_loaders:
+                generator = t.Generator().manual_seed(0)
+                indices = t.randperm(len(test_loader.dataset), generator=generator)[:subset_size]
+                self.test_subset_loaders[subset_size] = DataLoader(
+                    Subset(test_loader.dataset, indices.tolist()),
+                    batch_size=self.args.batch_size,
+                    shuffle=False,
+                    num_workers=4,
+                    pin_memory=True,
+                )
+            test_loader = self.test_subset_loaders[subset_size]
 
-        accuracy = total_correct / total_samples
-        wandb.log({"accuracy": accuracy}, step=self.step)
+        self.model.eval()
+        metrics = evaluate_tokens(
+            self.model, tqdm(test_loader, desc="Evaluating"), autocast=self.autocast
+        )
+        wandb.log(metrics, step=self.step)
         self.model.train()
-        return accuracy
+        return metrics
 
     def train(self):
         """
@@ -738,9 +1749,18 @@ class TransformerTrainer:
 
         progress_bar = tqdm(total=self.args.max_steps_per_epoch * self.args.epochs)
 
-        for epoch in range(self.args.epochs):
+        stream = self.train_loader.dataset
+        stream = stream if isinstance(stream, StreamingTokenDataset) else None
+        # A stream restored from a checkpoint resumes from its epoch (and its cursor within it)
+        first_epoch = 0 if stream is None else stream.epoch
+
+        for epoch in range(first_epoch, self.args.epochs):
+            if stream is not None:
+                stream.set_epoch(epoch)
             for i, batch in enumerate(self.train_loader):
                 loss = self.training_step(batch)
+                if stream is not None:
+                    stream.advance(batch)
                 progress_bar.update()
                 progress_bar.set_description(
                     f"Epoch {epoch + 1}, loss: {loss:.3f}, accuracy: {accuracy:.3f}"
@@ -748,7 +1768,7 @@ class TransformerTrainer:
                 if i >= self.args.max_steps_per_epoch:
                     break
 
-            accuracy = self.evaluate()
+            accuracy = self.evaluate(self.args.eval_subset_size)["accuracy"]
             sample_text = self.sampler.sample("Once upon a time", max_tokens_generated=50)
             print(sample_text)
 
@@ -764,6 +1784,273 @@ if MAIN:
 
 # %%
 
+if MAIN:
+    # Compare `evaluate_tokens` with evaluating from the full logits, with a `.item()` sync per batch (as `evaluate` did
+    # before), and with evaluating on a fixed subset of 100 sequences
+    @t.inference_mode()
+    def evaluate_full_logits(model: DemoTransformer, loader: DataLoader) -> float:
+        total_correct, total_samples = 0, 0
+        for batch in loader:
+            tokens = batch["tokens"].to(device)
+            predicted_tokens = model(tokens)[:, :-1].argmax(dim=-1)
+            total_correct += (predicted_tokens == tokens[:, 1:]).sum().item()
+            total_samples += tokens.size(0) * (tokens.size(1) - 1)
+        return total_correct / total_samples
+
+    wandb.init(mode="disabled")
+    table = Table("evaluation", "time (s)", "peak memory (MB)", "loss", "accuracy")
+    for name, evaluate_fn in [
+        ("full logits", lambda: {"accuracy": evaluate_full_logits(model, trainer.test_loader)}),
+        ("evaluate_tokens", lambda: evaluate_tokens(model, trainer.test_loader)),
+        ("evaluate_tokens, 100 sequences", lambda: trainer.evaluate(100)),
+    ]:
+        start = time.perf_counter()
+        metrics = evaluate_fn()
+        elapsed = time.perf_counter() - start
+        peak_mb = peak_rss_mb(evaluate_fn) if device.type == "cpu" else float("nan")
+        table.add_row(
+            name,
+            f"{elapsed:.2f}",
+            f"{peak_mb:.0f}",
+            f"{metrics.get('loss', float('nan')):.3f}",
+            f"{metrics['accuracy']:.3f}",
+        )
+    rprint(table)
+    wandb.finish()
+
+# %%
+
+if MAIN:
+    # Compare fp32 training with bf16 autocast (on CPU, when that's the device): steps/s, peak memory, and the loss
+    # curves from the same initialization & batches, which should track each other closely
+    wandb.init(mode="disabled")
+    set_seed(0)
+    model_fp32 = DemoTransformer(model_cfg).to(device)
+    batches = [train_dataset[i * args.batch_size : (i + 1) * args.batch_size] for i in range(50)]
+    loss_curves = {}
+    table = Table(
+        "precision", "steps/s", "peak memory (MB)", "final loss", title=f"Training on {device.type}"
+    )
+    for mixed_precision in [None, "bf16"]:
+        precision_trainer = TransformerTrainer(
+            TransformerTrainingArgs(mixed_precision=mixed_precision), copy.deepcopy(model_fp32)
+        )
+        losses = loss_curves[mixed_precision or "fp32"] = []
+        start = time.perf_counter()
+        peak_mb = peak_rss_mb(
+            lambda: [
+                losses.append(precision_trainer.training_step(batch).item()) for batch in batches
+            ]
+        )
+        steps_per_second = len(batches) / (time.perf_counter() - start)
+        table.add_row(
+            mixed_precision or "fp32",
+            f"{steps_per_second:.2f}",
+            f"{peak_mb:.0f}",
+            f"{losses[-1]:.3f}",
+        )
+    rprint(table)
+    wandb.finish()
+
+    loss_diff = np.abs(np.array(loss_curves["fp32"]) - np.array(loss_curves["bf16"]))
+    print(f"Max difference between the fp32 & bf16 loss curves: {loss_diff.max():.4f}")
+    assert loss_diff.max() < 0.1
+
+# %%
+
+if MAIN:
+    # Train at the full context length of 1024 with an effective batch of 8, and see how gradient accumulation and
+    # checkpointing more of the blocks trade throughput for peak memory
+    wandb.init(mode="disabled")
+    long_cfg = replace(
+        model_cfg, n_ctx=1024, d_model=256, n_heads=4, d_head=64, d_mlp=1024, n_layers=12
+    )
+    batch = {"tokens": t.randint(0, long_cfg.d_vocab, (8, long_cfg.n_ctx))}
+    table = Table(
+        "grad_accum_steps",
+        "checkpoint_blocks",
+        "peak memory (MB)",
+        "tokens/s",
+        title="Training at n_ctx=1024, batch size 8",
+    )
+    for grad_accum_steps in [1, 4]:
+        for checkpoint_blocks in [0, 4, 8, 12]:
+            memory_trainer = TransformerTrainer(
+                TransformerTrainingArgs(batch_size=8, grad_accum_steps=grad_accum_steps),
+                DemoTransformer(replace(long_cfg, checkpoint_blocks=checkpoint_blocks)).to(device),
+            )
+            # The first step allocates the optimizer state, so only measure the second
+            memory_trainer.training_step(batch)
+            start = time.perf_counter()
+            peak_mb = peak_rss_mb(lambda: memory_trainer.training_step(batch))
+            tokens_per_second = batch["tokens"].numel() / (time.perf_counter() - start)
+            table.add_row(
+                str(grad_accum_steps),
+                str(checkpoint_blocks),
+                f"{peak_mb:.0f}",
+                f"{tokens_per_second:.0f}",
+            )
+    rprint(table)
+    wandb.finish()
+
+# %%
+
+if MAIN:
+    # Peak training memory & throughput with the loss computed from the full logits, compared to chunked. At n_ctx=512
+    # and batch 4, the logits alone are 4 * 512 * 50257 floats (~400 MB), and the log-softmax makes another copy
+    wandb.init(mode="disabled")
+    vocab_cfg = replace(model_cfg, n_ctx=512)
+    batch = {"tokens": t.randint(0, vocab_cfg.d_vocab, (4, vocab_cfg.n_ctx))}
+    table = Table(
+        "loss_chunk_size",
+        "peak memory (MB)",
+        "tokens/s",
+        "loss",
+        title="Training with chunked cross entropy, n_ctx=512, batch size 4",
+    )
+    for loss_chunk_size in [None, 2048, 512, 128]:
+        set_seed(0)
+        vocab_trainer = TransformerTrainer(
+            TransformerTrainingArgs(batch_size=4, loss_chunk_size=loss_chunk_size),
+            DemoTransformer(vocab_cfg).to(device),
+        )
+        # The first step allocates the optimizer state, so only measure the second
+        loss = vocab_trainer.training_step(batch)
+        start = time.perf_counter()
+        peak_mb = peak_rss_mb(lambda: vocab_trainer.training_step(batch))
+        tokens_per_second = batch["tokens"].numel() / (time.perf_counter() - start)
+        table.add_row(
+            str(loss_chunk_size),
+            f"{peak_mb:.0f}",
+            f"{tokens_per_second:.0f}",
+            f"{loss.item():.4f}",
+        )
+    rprint(table)
+    wandb.finish()
+
+# %%
+
+if MAIN:
+    # Stream the training tokens instead, shuffled with a bounded buffer (this works the same for any number of token
+    # shards, or raw text shards). A cursor saved part way through an epoch resumes the exact same stream, even in a
+    # new dataset & DataLoader, so `TransformerTrainer(args, model, train_data=stream)` can pick up where it stopped
+    def make_stream() -> StreamingTokenDataset:
+        return StreamingTokenDataset(
+            [f"{data_path}-train"],
+            n_ctx=model.cfg.n_ctx,
+            bos_token_id=reference_gpt2.tokenizer.bos_token_id,
+            shuffle_buffer_size=10_000,
+        )
+
+    def stream_batches(stream: StreamingTokenDataset, n_batches: int) -> list[Tensor]:
+        loader = DataLoader(stream, batch_size=args.batch_size, num_workers=4)
+        batches = []
+        for batch in itertools.islice(loader, n_batches):
+            stream.advance(batch)
+            batches.append(batch["tokens"])
+        return batches
+
+    start = time.perf_counter()
+    peak_mb = peak_rss_mb(lambda: stream_batches(make_stream(), 1))
+    print(f"First batch after {time.perf_counter() - start:.2f}s, peak memory {peak_mb:.0f} MB")
+
+    uninterrupted = stream_batches(make_stream(), 30)
+    stream = make_stream()
+    stream_batches(stream, 20)
+    resumed = make_stream()
+    resumed.load_state_dict(stream.state_dict())
+    for batch, expected in zip(stream_batches(resumed, 10), uninterrupted[20:]):
+        t.testing.assert_close(batch, expected)
+    print(f"Resumed from {stream.state_dict()}")
+
+# %%
+
+if MAIN:
+    # Train on documents packed into full rows with segment ids (so attention stays within each document), compared to
+    # one document per row padded to the longest in the batch, at n_ctx=256: how many of the tokens are real, and how
+    # many real tokens we train on per second
+    pack_cfg = replace(model_cfg, n_ctx=256)
+    pack_batch_size = 8
+    bos_token_id = reference_gpt2.tokenizer.bos_token_id
+    packed_dataset = MemmapTokenDataset(
+        f"{data_path}-train",
+        n_ctx=pack_cfg.n_ctx,
+        bos_token_id=bos_token_id,
+        return_segment_ids=True,
+    )
+    n_batches = 10
+    packed_batches = [
+        packed_dataset[i * pack_batch_size : (i + 1) * pack_batch_size] for i in range(n_batches)
+    ]
+    padded_batches = []
+    for i in range(n_batches):
+        rows = []
+        for doc in range(i * pack_batch_size, (i + 1) * pack_batch_size):
+            start, end = packed_dataset.doc_offsets[doc : doc + 2]
+            row = t.from_numpy(packed_dataset.tokens[start:end].astype(np.int64))
+            rows.append(F.pad(row, (1, 0), value=bos_token_id)[: pack_cfg.n_ctx])
+        padded_batches.append(
+            {
+                "tokens": nn.utils.rnn.pad_sequence(rows, batch_first=True),
+                "attention_mask": nn.utils.rnn.pad_sequence(
+                    [t.ones_like(row, dtype=t.bool) for row in rows], batch_first=True
+                ),
+            }
+        )
+
+    def packing_train_step(
+        model: DemoTransformer, optimizer: t.optim.Optimizer, batch: dict[str, Tensor]
+    ) -> None:
+        tokens = batch["tokens"].to(device)
+        attention_mask = batch.get("attention_mask", t.ones_like(tokens, dtype=t.bool)).to(device)
+        segment_ids = batch["segment_ids"].to(device) if "segment_ids" in batch else None
+        logits = model(
+            tokens,
+            attention_mask=None if segment_ids is not None else attention_mask,
+            segment_ids=segment_ids,
+        )
+        # Don't train on predicting padding
+        is_target = attention_mask[:, 1:]
+        loss = -(get_log_probs(logits, tokens) * is_target).sum() / is_target.sum()
+        loss.backward()
+        optimizer.step()
+        optimizer.zero_grad()
+
+    table = Table(
+        "batches",
+        "real tokens / batch",
+        "utilization",
+        "real tokens/s",
+        title=f"Packed vs padded training, n_ctx={pack_cfg.n_ctx}",
+    )
+    for name, batches in [("padded", padded_batches), ("packed", packed_batches)]:
+        set_seed(0)
+        packing_model = DemoTransformer(pack_cfg).to(device)
+        optimizer = t.optim.AdamW(packing_model.parameters(), lr=args.lr)
+        packing_train_step(packing_model, optimizer, batches[0])
+        start = time.perf_counter()
+        for batch in batches:
+            packing_train_step(packing_model, optimizer, batch)
+        elapsed = time.perf_counter() - start
+        n_real = sum(
+            (
+                int(batch["attention_mask"].sum())
+                if "attention_mask" in batch
+                else batch["tokens"].numel()
+            )
+            for batch in batches
+        )
+        n_total = sum(batch["tokens"].numel() for batch in batches)
+        table.add_row(
+            name,
+            f"{n_real / n_batches:.0f}",
+            f"{n_real / n_total:.1%}",
+            f"{n_real / elapsed:.0f}",
+        )
+    rprint(table)
+
+# %%
+
 if MAIN:
     d_vocab = model.cfg.d_vocab
 
@@ -773,10 +2060,12 @@ if MAIN:
 # %%
 
 if MAIN:
-    toks = tokenized_dataset[:]["tokens"].flatten()
-
+    # Count tokens in chunks, since `np.bincount` converts its input to int64
     d_vocab = model.cfg.d_vocab
-    freqs = t.bincount(toks, minlength=d_vocab)
+    freqs = sum(
+        t.from_numpy(np.bincount(train_dataset.tokens[i : i + 2**24], minlength=d_vocab))
+        for i in range(0, train_dataset.n_tokens, 2**24)
+    )
     probs = freqs.float() / freqs.sum()
 
     distn = t.distributions.categorical.Categorical(probs=probs)
@@ -793,6 +2082,12 @@ def sampling_fn(model: DemoTransformer, prompt: str) -> str:
     return output
 
 
+def batch_sampling_fn(model: DemoTransformer, prompts: list[str]) -> list[str]:
+    sampler = TransformerSampler(model, reference_gpt2.tokenizer)
+    output = sampler.sample_batch(prompts, temperature=0.7, top_p=0.95, max_tokens_generated=16)
+    return output
+
+
 if MAIN:
     model = DemoTransformer(model_cfg).to(device)
 
@@ -808,6 +2103,7 @@ class TransformerTrainingArgsLogText(TransformerTrainingArgs):
     table_log_freq: int = 200
 
     def __post_init__(self):
+        super().__post_init__()
         assert (
             self.table_log_freq >= self.text_sample_freq
         ), "You should log the table less frequently than you add text to it."
@@ -819,19 +2115,28 @@ def train_log_text(self: TransformerTrainer, sampling_fn: Callable, prompt_list:
     for each epoch at `self.args.max_steps_per_epoch` steps.
 
     This also takes 2 extra arguments:
-        sampling_fn: function which takes model & a single prompt (i.e. text string) and returns text string output
+        sampling_fn: function which takes model & a list of prompts, and returns a list of text string outputs (one
+            per prompt), e.g. `batch_sampling_fn`
         prompt_list: list of prompts we'll log output on
     """
     wandb.init(project=self.args.wandb_project, name=self.args.wandb_name, config=self.args)
     accuracy = np.nan
     progress_bar = tqdm(total=self.args.max_steps_per_epoch * self.args.epochs)
 
+    stream = self.train_loader.dataset
+    stream = stream if isinstance(stream, StreamingTokenDataset) else None
+    first_epoch = 0 if stream is None else stream.epoch
+
     # Create a list for storing data
     completions_list = []
 
-    for epoch in range(self.args.epochs):
+    for epoch in range(first_epoch, self.args.epochs):
+        if stream is not None:
+            stream.set_epoch(epoch)
         for i, batch in enumerate(self.train_loader):
             loss = self.training_step(batch)
+            if stream is not None:
+                stream.advance(batch)
             progress_bar.update()
             progress_bar.set_description(
                 f"Epoch {epoch + 1}, loss: {loss:.3f}, accuracy: {accuracy:.3f}"
@@ -839,7 +2144,7 @@ def train_log_text(self: TransformerTrainer, sampling_fn: Callable, prompt_list:
 
             # Control the adding of text to the table, and the logging of text
             if self.step % self.args.text_sample_freq == 0:
-                text_completions = [sampling_fn(self.model, prompt) for prompt in prompt_list]
+                text_completions = sampling_fn(self.model, prompt_list)
                 completions_list.append([epoch, self.step, *text_completions])
             if self.step % self.args.table_log_freq == 0:
                 wandb.log(
@@ -858,7 +2163,7 @@ def train_log_text(self: TransformerTrainer, sampling_fn: Callable, prompt_list:
             if i >= self.args.max_steps_per_epoch:
                 break
 
-        accuracy = self.evaluate()
+        accuracy = self.evaluate(self.args.eval_subset_size)["accuracy"]
 
     wandb.finish()
 
@@ -876,32 +2181,253 @@ if MAIN:
     model = DemoTransformer(model_cfg).to(device)
     args = TransformerTrainingArgsLogText()
     trainer = TransformerTrainer(args, model)
-    trainer.train(sampling_fn, prompt_list)
+    trainer.train(batch_sampling_fn, prompt_list)
     # Read full report here - https://api.wandb.ai/links/callum-mcdougall/5ex16e5w
 
 # %%
 
 
+class PrefixCache:
+    """
+    LRU cache of the keys & values computed for prompt prefixes, so prompts which start the same way (e.g. a shared
+    system prompt, or the same evaluation prompts every few steps) don't need to be run through the model again.
+
+    Prefixes are split into chunks of `chunk_size` tokens, and each chunk's keys & values are stored under a hash of the
+    whole prefix up to the end of that chunk. Looking up a prompt walks its chunks until one isn't cached, so prompts
+    share entries for as many chunks as they have in common. Entries also keep the prefix's token ids, which are
+    compared on lookup, so a hash collision is a miss rather than the wrong keys & values. The least recently used
+    chunks are evicted once the cache uses more than `max_bytes`.
+
+    Cached keys & values depend on the model's weights, so the cache is cleared whenever they change (which we detect
+    from the parameters' version counters, which in-place updates like `optimizer.step()` increment).
+    """
+
+    def __init__(self, model: DemoTransformer, max_bytes: int = 256 * 2**20, chunk_size: int = 16):
+        self.model = model
+        self.max_bytes = max_bytes
+        self.chunk_size = chunk_size
+        # Maps prefix hash -> (prefix token ids, per-layer (keys, values) for the last chunk of that prefix), least
+        # recently used first
+        self.entries: OrderedDict[int, tuple[tuple[int, ...], list[tuple[Tensor, Tensor]]]] = (
+            OrderedDict()
+        )
+        self.n_bytes = 0
+        self.n_hits = 0
+        self.n_misses = 0
+        self.weights_version = self.get_weights_version()
+
+    def get_weights_version(self) -> tuple:
+        # Quantized weights are buffers rather than parameters, so we include those too
+        return tuple(
+            (p.data_ptr(), 0 if p.is_inference() else p._version)
+            for p in itertools.chain(self.model.parameters(), self.model.buffers())
+        )
+
+    def clear(self) -> None:
+        self.entries.clear()
+        self.n_bytes = 0
+
+    def check_weights(self) -> None:
+        """Clears the cache if the model's weights have changed since it was filled."""
+        weights_version = self.get_weights_version()
+        if weights_version != self.weights_version:
+            self.clear()
+            self.weights_version = weights_version
+
+    def chunk_hashes(self, input_ids: Int[Tensor, "seq_len"]) -> list[tuple[int, tuple[int, ...]]]:
+        """
+        Hashes (each one chained on the previous one) & token ids of the prefixes ending at each full chunk of
+        `input_ids`.
+        """
+        ids = input_ids.tolist()
+        prefix_hash, hashes = 0, []
+        for end in range(self.chunk_size, len(ids) + 1, self.chunk_size):
+            prefix_hash = hash((prefix_hash, *ids[end - self.chunk_size : end]))
+            hashes.append((prefix_hash, tuple(ids[:end])))
+        return hashes
+
+    def lookup(self, input_ids: Int[Tensor, "seq_len"]) -> tuple[int, KeyValueCache]:
+        """
+        Returns the number of leading tokens of `input_ids` which are cached, and a `KeyValueCache` filled with their
+        keys & values. At least one token is always left uncached, so the caller still gets logits for the last one.
+        """
+        self.check_weights()
+        kv_cache = KeyValueCache(self.model.cfg)
+        chunks = []
+        for prefix_hash, prefix_ids in self.chunk_hashes(input_ids[:-1]):
+            if prefix_hash not in self.entries or self.entries[prefix_hash][0] != prefix_ids:
+                break
+            self.entries.move_to_end(prefix_hash)
+            chunks.append(self.entries[prefix_hash][1])
+
+        if chunks:
+            self.n_hits += 1
+            for layer, entry in enumerate(kv_cache.entries):
+                entry.k = t.cat([chunk[layer][0] for chunk in chunks], dim=1)
+                entry.v = t.cat([chunk[layer][1] for chunk in chunks], dim=1)
+        else:
+            self.n_misses += 1
+        return len(chunks) * self.chunk_size, kv_cache
+
+    def insert(self, input_ids: Int[Tensor, "seq_len"], kv_cache: KeyValueCache) -> None:
+        """Stores the keys & values of every full chunk of `input_ids` from `kv_cache` (which holds at least them)."""
+        self.check_weights()
+        for i, (prefix_hash, prefix_ids) in enumerate(self.chunk_hashes(input_ids)):
+            if prefix_hash in self.entries:
+                if self.entries[prefix_hash][0] == prefix_ids:
+                    self.entries.move_to_end(prefix_hash)
+                    continue
+                # A different prefix with the same hash, which we replace
+                _, old_chunk = self.entries.pop(prefix_hash)
+                self.n_bytes -= sum(k.nbytes + v.nbytes for k, v in old_chunk)
+            positions = slice(i * self.chunk_size, (i + 1) * self.chunk_size)
+            chunk = [
+                (entry.k[:, positions].clone(), entry.v[:, positions].clone())
+                for entry in kv_cache.entries
+            ]
+            self.entries[prefix_hash] = (prefix_ids, chunk)
+            self.n_bytes += sum(k.nbytes + v.nbytes for k, v in chunk)
+
+        # Evict the least recently used chunks until we're within budget
+        while self.n_bytes > self.max_bytes and self.entries:
+            _, (_, chunk) = self.entries.popitem(last=False)
+            self.n_bytes -= sum(k.nbytes + v.nbytes for k, v in chunk)
+
+
+# %%
+
+
+class IncrementalDetokenizer:
+    """
+    Turns a stream of token ids into text deltas, without re-decoding the whole sequence every step.
+
+    Byte-level BPE tokens don't always end on a character boundary (e.g. an emoji can be split across several tokens),
+    so we only decode a short window of recent tokens, and hold text back while it ends in a partial character (which
+    decodes to the replacement character U+FFFD).
+    """
+
+    def __init__(self, tokenizer: GPT2TokenizerFast, prompt_ids: list[int] | None = None):
+        self.tokenizer = tokenizer
+        self.token_ids = list(prompt_ids or [])
+        # Text from `prefix_offset` to `read_offset` has already been emitted (we start a few tokens back so the
+        # decoder sees the context for the first new token, e.g. whether it's preceded by a space)
+        self.read_offset = len(self.token_ids)
+        self.prefix_offset = max(self.read_offset - 5, 0)
+
+    def add(self, token_id: int) -> str:
+        """Adds a new token, and returns the text it completes (empty if it ends partway through a character)."""
+        self.token_ids.append(token_id)
+        prefix_text = self.tokenizer.decode(self.token_ids[self.prefix_offset : self.read_offset])
+        new_text = self.tokenizer.decode(self.token_ids[self.prefix_offset :])
+        if len(new_text) <= len(prefix_text) or new_text.endswith("\ufffd"):
+            return ""
+        self.prefix_offset, self.read_offset = self.read_offset, len(self.token_ids)
+        return new_text[len(prefix_text) :]
+
+
+# %%
+
+
 class TransformerSampler:
-    def __init__(self, model: DemoTransformer, tokenizer: GPT2TokenizerFast):
+    def __init__(
+        self,
+        model: DemoTransformer,
+        tokenizer: GPT2TokenizerFast,
+        prefix_cache: PrefixCache | None = None,
+    ):
         self.model = model
         self.cfg = model.cfg
         self.tokenizer = tokenizer
+        # If given, `sample` and `stream` reuse the keys & values of previously seen prompt prefixes
+        self.prefix_cache = prefix_cache
 
     @t.inference_mode()
-    def sample(self, prompt: str, max_tokens_generated=100, verbose=False, **kwargs) -> str:
+    def sample(
+        self, prompt: str, max_tokens_generated=100, verbose=False, use_cache=True, **kwargs
+    ) -> str:
         """
         Returns a string of autoregressively generated text, starting from the prompt.
 
         Sampling terminates at max_tokens_generated, or when the model generates an end-of-sequence token. kwargs are
         passed to sample_next_token, to give detailed instructions on how new tokens are chosen.
+
+        If `use_cache` is True, the prompt is run through the model once and each later step only feeds in the newest
+        token, reusing the keys & values of earlier positions from a `KeyValueCache`.
+        """
+        self.model.eval()
+        input_ids = self.tokenizer.encode(prompt, return_tensors="pt").to(device)[0]
+        new_token_ids = []
+
+        if verbose:
+            detokenizer = IncrementalDetokenizer(self.tokenizer, input_ids.tolist())
+            print(prompt, end="", flush=True)
+        for next_token in self.generate_token_ids(
+            input_ids, max_tokens_generated, use_cache, **kwargs
+        ):
+            new_token_ids.append(next_token)
+            # Print out results, if required (only the newly decoded text, rather than re-decoding everything)
+            if verbose:
+                print(detokenizer.add(next_token), end="", flush=True)
+        if verbose:
+            print()
+
+        return self.tokenizer.decode(input_ids.tolist() + new_token_ids)
+
+    @t.inference_mode()
+    def stream(
+        self, prompt: str, max_tokens_generated=100, use_cache=True, **kwargs
+    ) -> Iterator[tuple[int, str]]:
+        """
+        Streaming version of `sample`: yields each new token id as soon as it's generated, along with the text it adds
+        to the completion (which can be empty, if the token ends partway through a multi-byte character).
+
+        Joining all the text deltas gives the completion returned by `sample` (minus the prompt), except that a partial
+        character left at the very end of generation is never emitted.
         """
         self.model.eval()
         input_ids = self.tokenizer.encode(prompt, return_tensors="pt").to(device)[0]
+        detokenizer = IncrementalDetokenizer(self.tokenizer, input_ids.tolist())
+
+        for next_token in self.generate_token_ids(
+            input_ids, max_tokens_generated, use_cache, **kwargs
+        ):
+            yield next_token, detokenizer.add(next_token)
+
+    def generate_token_ids(
+        self,
+        input_ids: Int[Tensor, "seq_len"],
+        max_tokens_generated=100,
+        use_cache=True,
+        **kwargs,
+    ) -> Iterator[int]:
+        """
+        Autoregressively generates tokens following `input_ids`, yielding each new token id. This is the loop shared
+        by `sample` and `stream` (which should be used instead, since they put the model in eval & inference mode).
+
+        If `seed` is passed, it seeds a generator which is used for this request only.
+        """
+        if kwargs.get("seed") is not None and kwargs.get("generator") is None:
+            kwargs["generator"] = TransformerSampler.make_generator(kwargs["seed"])
+        kwargs.pop("seed", None)
+        kv_cache = None
 
         for _ in range(max_tokens_generated):
-            # Get new logits (make sure we don't pass in more tokens than the model's context length)
-            logits = self.model(input_ids[None, -self.cfg.n_ctx :])
+            if use_cache and len(input_ids) <= self.cfg.n_ctx:
+                # Fill the cache from the whole prompt on the first step (skipping any prefix that's already in the prefix
+                # cache), then only pass in the newest token
+                if kv_cache is None and self.prefix_cache is not None:
+                    n_cached, kv_cache = self.prefix_cache.lookup(input_ids)
+                    logits = self.model(input_ids[None, n_cached:], kv_cache)
+                    self.prefix_cache.insert(input_ids, kv_cache)
+                elif kv_cache is None:
+                    kv_cache = KeyValueCache(self.cfg)
+                    logits = self.model(input_ids[None], kv_cache)
+                else:
+                    logits = self.model(input_ids[None, -1:], kv_cache)
+            else:
+                # Get new logits (make sure we don't pass in more tokens than the model's context length). Once we're
+                # past the context length every token shifts position each step, so cached keys & values can't be used
+                logits = self.model(input_ids[None, -self.cfg.n_ctx :])
             # We only take logits for the last token, because this is what we're sampling
             logits = logits[0, -1]
             # Get next token (as a tensor of size (1, 1) so we can concat it to input_ids)
@@ -910,14 +2436,89 @@ class TransformerSampler:
             )
             # Create new input ids string, with shape (1, old_seq_len + 1)
             input_ids = t.cat([input_ids, next_token], dim=-1)
-            # Print out results, if required
-            if verbose:
-                print(self.tokenizer.decode(input_ids), end="\r")
+            yield next_token.item()
             # If our new token was the end-of-text token, stop
             if next_token == getattr(self.tokenizer, "eos_token_id", None):
                 break
 
-        return self.tokenizer.decode(input_ids)
+    @t.inference_mode()
+    def sample_batch(self, prompts: list[str], max_tokens_generated=100, **kwargs) -> list[str]:
+        """
+        Batched version of `sample`, which generates completions for all prompts together (one forward pass per step).
+
+        Prompts are left-padded to the same length, and padding is masked out of attention. Each sequence stops
+        independently when it generates an end-of-sequence token (after which it's fed padding until all sequences
+        are finished). kwargs are passed to sample_next_tokens, so can be per-prompt tensors.
+
+        `seed` can be a single seed for the batch, or a list with one per prompt (in which case each completion only
+        depends on its own seed, so it's the same whichever other prompts it's batched with, up to numerical
+        differences from padding). This isn't the same completion as `sample` gives with that seed, since the batched
+        sampler draws tokens differently.
+        """
+        self.model.eval()
+        eos_token_id = getattr(self.tokenizer, "eos_token_id", None)
+        # Finished sequences are fed the same padding token as `encode_batch` uses
+        pad_token_id = eos_token_id if eos_token_id is not None else 0
+        input_ids, attention_mask = self.encode_batch(prompts)
+        finished = t.zeros(len(prompts), dtype=t.bool, device=device)
+        kv_cache = None
+
+        seed = kwargs.pop("seed", None)
+        if seed is not None and kwargs.get("generator") is None:
+            kwargs["generator"] = (
+                [TransformerSampler.make_generator(row_seed) for row_seed in seed]
+                if isinstance(seed, list)
+                else TransformerSampler.make_generator(seed)
+            )
+
+        for _ in range(max_tokens_generated):
+            if input_ids.size(1) <= self.cfg.n_ctx:
+                if kv_cache is None:
+                    kv_cache = KeyValueCache(self.cfg)
+                    logits = self.model(input_ids, kv_cache, attention_mask)
+                else:
+                    logits = self.model(input_ids[:, -1:], kv_cache, attention_mask)
+            else:
+                logits = self.model(
+                    input_ids[:, -self.cfg.n_ctx :],
+                    attention_mask=attention_mask[:, -self.cfg.n_ctx :],
+                )
+            logits = logits[:, -1]
+            # Sample the next token for every sequence at once (padding is ignored for frequency penalties)
+            next_tokens = TransformerSampler.sample_next_tokens(
+                input_ids, logits, attention_mask=attention_mask, **kwargs
+            )
+            # Sequences which have already finished just get more padding
+            next_tokens = t.where(finished, pad_token_id, next_tokens)
+            input_ids = t.cat([input_ids, next_tokens[:, None]], dim=-1)
+            attention_mask = t.cat([attention_mask, ~finished[:, None]], dim=-1)
+            if eos_token_id is not None:
+                finished = finished | (next_tokens == eos_token_id)
+                if finished.all():
+                    break
+
+        return [self.tokenizer.decode(ids[mask]) for ids, mask in zip(input_ids, attention_mask)]
+
+    def encode_batch(
+        self, prompts: list[str]
+    ) -> tuple[Int[Tensor, "batch seq"], Bool[Tensor, "batch seq"]]:
+        """
+        Tokenizes all prompts together, and left-pads them so the most recent tokens line up. Returns the token ids
+        and the attention mask (True for real tokens, False for padding).
+        """
+        eos_token_id = getattr(self.tokenizer, "eos_token_id", None)
+        # GPT-2 has no padding token, so we pad with end-of-text (it's masked out anyway)
+        pad_token_id = eos_token_id if eos_token_id is not None else 0
+
+        encoded = self.tokenizer(prompts)["input_ids"]
+        max_len = max(len(ids) for ids in encoded)
+        input_ids = t.tensor(
+            [[pad_token_id] * (max_len - len(ids)) + ids for ids in encoded], device=device
+        )
+        attention_mask = t.tensor(
+            [[False] * (max_len - len(ids)) + [True] * len(ids) for ids in encoded], device=device
+        )
+        return input_ids, attention_mask
 
     @staticmethod
     def sample_next_token(
@@ -928,17 +2529,21 @@ class TransformerSampler:
         top_p=0.0,
         frequency_penalty=0.0,
         seed=None,
+        generator: t.Generator | None = None,
     ) -> int:
+        """
+        Randomness comes from `generator` if given (so concurrent requests don't share or reset global RNG state), else
+        from a new generator seeded with `seed`, else from torch's global RNG.
+        """
         assert input_ids.ndim == 1, "input_ids should be a 1D sequence of token ids"
         assert temperature >= 0, "Temperature should be non-negative"
         assert 0 <= top_p <= 1.0, "Top-p must be a probability"
         assert 0 <= top_k, "Top-k must be non-negative"
         assert not (top_p != 0 and top_k != 0), "At most one of top-p and top-k supported"
 
-        # Set random seeds for reproducibility
-        if seed is not None:
-            t.manual_seed(seed)
-            np.random.seed(seed)
+        # Seed a generator for reproducibility
+        if generator is None and seed is not None:
+            generator = TransformerSampler.make_generator(seed, logits.device)
 
         # Apply all the specialized sampling methods
         if temperature == 0:
@@ -950,10 +2555,115 @@ class TransformerSampler:
                 input_ids, logits, frequency_penalty
             )
         if top_k > 0:
-            return TransformerSampler.sample_top_k(logits, top_k)
+            return TransformerSampler.sample_top_k(logits, top_k, generator=generator)
         if top_p > 0.0:
-            return TransformerSampler.sample_top_p(logits, top_p)
-        return TransformerSampler.sample_basic(logits)
+            return TransformerSampler.sample_top_p(logits, top_p, generator=generator)
+        return TransformerSampler.sample_basic(logits, generator=generator)
+
+    @staticmethod
+    def make_generator(seed: int, device: t.device | str = device) -> t.Generator:
+        """Returns a new random number generator, seeded with `seed` (independent of torch's global RNG)."""
+        return set_seed(seed, generator=t.Generator(device=device))
+
+    @staticmethod
+    def sample_next_tokens(
+        input_ids: Int[Tensor, "batch seq_len"],
+        logits: Float[Tensor, "batch d_vocab"],
+        temperature: float | Float[Tensor, "batch"] = 1.0,
+        top_k: int | Int[Tensor, "batch"] = 0,
+        top_p: float | Float[Tensor, "batch"] = 0.0,
+        frequency_penalty: float | Float[Tensor, "batch"] = 0.0,
+        attention_mask: Bool[Tensor, "batch seq_len"] | None = None,
+        generator: t.Generator | list[t.Generator] | None = None,
+    ) -> Int[Tensor, "batch"]:
+        """
+        Batched version of `sample_next_token`, which samples one token for every row of `logits` and returns them as a
+        tensor (without any host syncs). Each sampling argument can be a scalar, or a tensor giving a value per row.
+
+        Rows are processed in the same order as `sample_next_token`: temperature 0 means greedy, then the frequency
+        penalty is applied (ignoring tokens where `attention_mask` is False), then top-k if it's nonzero, else top-p if
+        it's nonzero.
+
+        `generator` can be a single generator for the whole batch, or one per row (so that each row's samples only
+        depend on its own generator, whichever other rows it's batched with).
+        """
+        batch, d_vocab = logits.shape
+
+        def per_row(value: float | Tensor, dtype: t.dtype) -> Tensor:
+            return t.as_tensor(value, dtype=dtype, device=logits.device).expand(batch)
+
+        temperature = per_row(temperature, logits.dtype)
+        greedy_tokens = logits.argmax(dim=-1)
+        logits = logits / t.where(temperature == 0, 1.0, temperature)[:, None]
+
+        if isinstance(frequency_penalty, Tensor) or frequency_penalty != 0.0:
+            # Count occurrences of each token in each row (bincount for a batch)
+            counts = t.zeros_like(logits).scatter_add_(
+                1,
+                input_ids,
+                (
+                    t.ones_like(input_ids, dtype=logits.dtype)
+                    if attention_mask is None
+                    else attention_mask.to(logits.dtype)
+                ),
+            )
+            logits = logits - per_row(frequency_penalty, logits.dtype)[:, None] * counts
+
+        if not isinstance(top_k, Tensor) and not isinstance(top_p, Tensor) and top_k > 0:
+            # The same top-k for every row, so we don't need to sort the whole vocab
+            top_k_logits, indices = logits.topk(min(top_k, d_vocab), dim=-1)
+            probs = top_k_logits.softmax(-1)
+            n_keep = t.full((batch,), probs.size(-1), device=logits.device)
+        elif isinstance(top_k, Tensor) or isinstance(top_p, Tensor) or top_p > 0.0:
+            # Sort the vocab once for all rows, then keep each row's top-k, or top-p if top-k is zero. Like
+            # `sample_top_p`, we keep tokens until cumulative probability reaches top_p (and always keep at least one)
+            top_k, top_p = per_row(top_k, t.long), per_row(top_p, logits.dtype)
+            probs, indices = logits.softmax(-1).sort(dim=-1, descending=True)
+            n_keep_top_p = (probs.cumsum(-1) < top_p[:, None]).sum(-1) + 1
+            n_keep = t.where(
+                top_k > 0, top_k.clamp(max=d_vocab), t.where(top_p > 0, n_keep_top_p, d_vocab)
+            )
+        else:
+            probs, indices = logits.softmax(-1), None
+            n_keep = t.full((batch,), d_vocab, device=logits.device)
+
+        # Inverse-CDF sampling over the first `n_keep` tokens of each row: draw u uniformly from [0, mass of the kept
+        # tokens), and pick the first token whose cumulative probability exceeds it. This needs one random number per
+        # row (rather than noise for the whole vocab), and doesn't need the probabilities renormalizing.
+        n_keep = n_keep[:, None]
+        cumul_probs = probs.cumsum(-1)
+        kept_mass = cumul_probs.gather(1, n_keep - 1)
+        if isinstance(generator, list):
+            u = t.cat([t.rand(1, generator=g, device=logits.device) for g in generator])[:, None]
+        else:
+            u = t.rand(batch, 1, generator=generator, device=logits.device)
+        u = u.to(cumul_probs.dtype) * kept_mass
+        choice = t.searchsorted(cumul_probs, u, right=True).clamp(max=n_keep - 1)
+        sampled_tokens = (choice if indices is None else indices.gather(1, choice)).squeeze(-1)
+        return t.where(temperature == 0, greedy_tokens, sampled_tokens)
+
+    @staticmethod
+    def get_probs(
+        logits: Float[Tensor, "batch d_vocab"], temperature=1.0, top_k=0, top_p=0.0
+    ) -> Float[Tensor, "batch d_vocab"]:
+        """
+        Returns the distribution which `sample_next_token` samples from, for each row of logits (without a frequency
+        penalty). Temperature 0 gives all the probability to the most likely token, and tokens excluded by top-k or
+        top-p get probability 0.
+        """
+        if temperature == 0:
+            return F.one_hot(logits.argmax(-1), logits.size(-1)).to(logits.dtype)
+        probs = (logits / temperature).softmax(-1)
+        if top_k > 0:
+            top_k_probs, indices = probs.topk(top_k, dim=-1)
+            probs = t.zeros_like(probs).scatter_(-1, indices, top_k_probs)
+        elif top_p > 0.0:
+            # Like `sample_top_p`, keep tokens until cumulative probability reaches top_p (and always keep one)
+            sorted_probs, indices = probs.sort(dim=-1, descending=True, stable=True)
+            n_keep = (sorted_probs.cumsum(-1) < top_p).sum(-1, keepdim=True) + 1
+            keep = t.arange(probs.size(-1), device=probs.device) < n_keep
+            probs = t.zeros_like(probs).scatter_(-1, indices, sorted_probs * keep)
+        return probs / probs.sum(-1, keepdim=True)
 
     @staticmethod
     def greedy_search(logits: Float[Tensor, "d_vocab"]) -> int:
@@ -983,26 +2693,31 @@ class TransformerSampler:
         return logits - freq_penalty * id_freqs
 
     @staticmethod
-    def sample_basic(logits: Float[Tensor, "d_vocab"]) -> int:
+    def sample_basic(logits: Float[Tensor, "d_vocab"], generator: t.Generator | None = None) -> int:
         """
         Samples from the distribution defined by the logits.
         """
-        return t.distributions.categorical.Categorical(logits=logits).sample().item()
+        return t.multinomial(logits.softmax(-1), 1, generator=generator).item()
 
     @staticmethod
-    def sample_top_k(logits: Float[Tensor, "d_vocab"], k: int) -> int:
+    def sample_top_k(
+        logits: Float[Tensor, "d_vocab"], k: int, generator: t.Generator | None = None
+    ) -> int:
         """
         Samples from the top k most likely tokens.
         """
         top_k_logits, top_k_token_ids = logits.topk(k)
         # Get sampled token (which is an index corresponding to the list of top-k tokens)
-        sampled_token_idx = t.distributions.categorical.Categorical(logits=top_k_logits).sample()
+        sampled_token_idx = t.multinomial(top_k_logits.softmax(-1), 1, generator=generator)
         # Get the actual token id, as an int
         return top_k_token_ids[sampled_token_idx].item()
 
     @staticmethod
     def sample_top_p(
-        logits: Float[Tensor, "d_vocab"], top_p: float, min_tokens_to_keep: int = 1
+        logits: Float[Tensor, "d_vocab"],
+        top_p: float,
+        min_tokens_to_keep: int = 1,
+        generator: t.Generator | None = None,
     ) -> int:
         """
         Samples from the most likely tokens which make up at least p cumulative probability.
@@ -1016,7 +2731,7 @@ class TransformerSampler:
         keep_idx = indices[:n_keep]
         keep_logits = logits[keep_idx]
         # Perform the sampling
-        sample = t.distributions.categorical.Categorical(logits=keep_logits).sample()
+        sample = t.multinomial(keep_logits.softmax(-1), 1, generator=generator)
         return keep_idx[sample].item()
 
     @t.inference_mode()
@@ -1057,6 +2772,130 @@ if MAIN:
 
 # %%
 
+if MAIN:
+    # The cached path should produce exactly the same greedy output as recomputing the whole sequence every step
+    prompt = "Jingle bells, jingle bells, jingle all the way"
+    for use_cache in [False, True]:
+        start = time.perf_counter()
+        output = sampler.sample(
+            prompt, max_tokens_generated=128, temperature=0.0, use_cache=use_cache
+        )
+        print(f"use_cache={use_cache}: {time.perf_counter() - start:.2f}s")
+        if use_cache:
+            assert output == output_no_cache, "Cached decoding should match full recompute"
+        else:
+            output_no_cache = output
+
+    print("Tests passed!")
+
+# %%
+
+if MAIN:
+    # Streaming should yield the same tokens as `sample`, and its text deltas should join up to the same completion
+    prompt = "Jingle bells, jingle bells, jingle all the way"
+    expected = sampler.sample(prompt, max_tokens_generated=32, temperature=0.0)
+
+    start = time.perf_counter()
+    deltas = []
+    for token_id, text in sampler.stream(prompt, max_tokens_generated=32, temperature=0.0):
+        if not deltas:
+            print(f"Time to first token: {time.perf_counter() - start:.3f}s")
+        deltas.append(text)
+    assert prompt + "".join(deltas) == expected
+
+    # Tokens which split a multi-byte character shouldn't produce text until the character is complete
+    emoji_ids = tokenizer.encode(" 🎉 done")
+    detokenizer = IncrementalDetokenizer(tokenizer)
+    emoji_deltas = [detokenizer.add(token_id) for token_id in emoji_ids]
+    print(list(zip(emoji_ids, emoji_deltas)))
+    assert "\ufffd" not in "".join(emoji_deltas) and "".join(emoji_deltas) == " 🎉 done"
+
+    print("Tests passed!")
+
+# %%
+
+if MAIN:
+    # Seeded requests should be reproducible even when interleaved with each other, since each one uses its own
+    # generator (rather than reseeding torch's global RNG)
+    prompt = "John and Mary went to the"
+    kwargs = dict(max_tokens_generated=16, temperature=0.9, top_p=0.95)
+    streams = [sampler.stream(prompt, seed=0, **kwargs), sampler.stream(prompt, seed=1, **kwargs)]
+    interleaved_tokens = [[], []]
+    for tokens in itertools.zip_longest(*streams):
+        for i, token in enumerate(tokens):
+            if token is not None:
+                interleaved_tokens[i].append(token[0])
+
+    for seed, tokens in enumerate(interleaved_tokens):
+        expected = sampler.sample(prompt, seed=seed, **kwargs)
+        assert tokenizer.decode(tokenizer.encode(prompt) + tokens) == expected
+
+    # With a seed per prompt, batched completions shouldn't depend on which other prompts are in the batch
+    prompts = ["John and Mary went to the", "Jingle bells, jingle bells, jingle all the way"]
+    outputs = sampler.sample_batch(prompts, seed=[0, 1], **kwargs)
+    outputs_reversed = sampler.sample_batch(prompts[::-1], seed=[1, 0], **kwargs)
+    assert outputs == outputs_reversed[::-1]
+
+    print("Tests passed!")
+
+# %%
+
+if MAIN:
+    # Requests which share a long prefix (like a system prompt) only need to run the prefix through the model once
+    system_prompt = (
+        "You are a helpful assistant who answers questions about the solar system. " * 20
+    )
+    questions = ["How big is Jupiter?", "How far away is Mars?", "What is Saturn made of?"]
+    prefix_cache = PrefixCache(model)
+    cached_sampler = TransformerSampler(model, tokenizer, prefix_cache=prefix_cache)
+
+    for name, s in [("no prefix cache", sampler), ("prefix cache", cached_sampler)]:
+        s.sample(system_prompt, max_tokens_generated=1)
+        start = time.perf_counter()
+        outputs = [
+            s.sample(system_prompt + q, max_tokens_generated=8, temperature=0.0) for q in questions
+        ]
+        print(f"{name}: {(time.perf_counter() - start) / len(questions):.3f}s per request")
+        if s is cached_sampler:
+            assert outputs == expected_outputs
+        else:
+            expected_outputs = outputs
+    print(f"Prefix cache: {prefix_cache.n_hits} hits, {prefix_cache.n_bytes / 2**20:.1f} MB")
+
+    # Changing the weights (e.g. an optimizer step) invalidates the cache
+    with t.no_grad():
+        model.unembed.b_U.add_(0.0)
+    prefix_cache.check_weights()
+    assert len(prefix_cache.entries) == 0
+
+    print("Tests passed!")
+
+# %%
+
+if MAIN:
+    # Batched generation should give the same greedy completions as sampling each prompt separately
+    prompts = [
+        "Jingle bells, jingle bells, jingle all the way",
+        "John and Mary went to the",
+        "The ships hung in the sky in much the same way that",
+    ]
+    start = time.perf_counter()
+    expected = [
+        sampler.sample(prompt, max_tokens_generated=32, temperature=0.0) for prompt in prompts
+    ]
+    print(f"Sequential: {time.perf_counter() - start:.2f}s")
+    start = time.perf_counter()
+    outputs = sampler.sample_batch(prompts, max_tokens_generated=32, temperature=0.0)
+    print(f"Batched:    {time.perf_counter() - start:.2f}s")
+
+    for prompt, output, expected_output in zip(prompts, outputs, expected):
+        print(f"Prompt: {prompt!r}\nOutput: {output!r}\n")
+        assert output == expected_output
+
+    print("Tests passed!")
+
+# %%
+
 if MAIN:
     prompt = "John and Mary went to the"
     input_ids = tokenizer.encode(prompt, return_tensors="pt").to(device)
@@ -1219,6 +3058,54 @@ if MAIN:
 
 # %%
 
+if MAIN:
+    # The batched sampler should match the distributions above, with different settings for different rows: here the
+    # first half of the rows use top-k=5, and the second half use top-p=0.1 (we sample in chunks, so the repeated
+    # logits don't take up too much memory)
+    N, chunk_size = 10_000, 500
+    top_k = t.tensor([5] * chunk_size + [0] * chunk_size, device=device)
+    top_p = t.tensor([0.0] * chunk_size + [0.1] * chunk_size, device=device)
+    tokens = t.stack(
+        [
+            TransformerSampler.sample_next_tokens(
+                input_ids.repeat(2 * chunk_size, 1),
+                logits.repeat(2 * chunk_size, 1),
+                top_k=top_k,
+                top_p=top_p,
+            )
+            for _ in range(N // chunk_size)
+        ]
+    )
+
+    for expected_freqs, row_tokens in [
+        (expected_top_5, tokens[:, :chunk_size]),
+        (expected_top_10pct, tokens[:, chunk_size:]),
+    ]:
+        total = sum(expected_freqs.values())
+        for word, expected_freq in expected_freqs.items():
+            observed_freq = (row_tokens == tokenizer.encode(word)[0]).float().mean().item()
+            print(
+                f"Word: {word!r:<9}. Expected freq {expected_freq / total:.4f}, observed freq {observed_freq:.4f}"
+            )
+            assert abs(observed_freq - expected_freq / total) < 0.01
+
+    # Compare per-step sampling overhead for a batch of 32 rows: looping over `sample_next_token` vs one batched call
+    batch_ids, batch_logits = input_ids.repeat(32, 1), logits.repeat(32, 1)
+    time_loop = benchmark(
+        lambda: [
+            TransformerSampler.sample_next_token(ids, row_logits, temperature=0.7, top_p=0.95)
+            for ids, row_logits in zip(batch_ids, batch_logits)
+        ]
+    )
+    time_batched = benchmark(
+        lambda: TransformerSampler.sample_next_tokens(
+            batch_ids, batch_logits, temperature=0.7, top_p=0.95
+        )
+    )
+    print(f"Loop: {time_loop * 1e3:.2f}ms, batched: {time_batched * 1e3:.2f}ms")
+
+# %%
+
 if MAIN:
     sampler = TransformerSampler(model, tokenizer)
 
@@ -1229,6 +3116,40 @@ if MAIN:
 # %%
 
 
+def ban_repeated_ngrams(
+    logprobs: Float[Tensor, "batch d_vocab"],
+    tokens: Int[Tensor, "batch seq"],
+    no_repeat_ngram_size: int | None,
+    attention_mask: Bool[Tensor, "batch seq"] | None = None,
+) -> Float[Tensor, "batch d_vocab"]:
+    """
+    Returns `logprobs` with every token that would complete an ngram of size `no_repeat_ngram_size` already in
+    `tokens` filled with -1e10 (for each sequence separately). Ngrams which include padding are ignored.
+    """
+    seq_len = tokens.size(1)
+
+    # If completion isn't long enough for a repetition, or we have no restrictions, there's nothing to ban
+    if (no_repeat_ngram_size is None) or (seq_len <= no_repeat_ngram_size - 1):
+        return logprobs
+
+    # First, get the most recent `no_repeat_ngram_size-1` tokens
+    last_ngram_prefix = tokens[:, seq_len - (no_repeat_ngram_size - 1) :]
+    # Next, get all past ngrams as a (batch, n_ngrams, ngram) view, and find which ones start with the prefix
+    ngrams = tokens.unfold(1, no_repeat_ngram_size, 1)
+    ngrams_are_repeated = (ngrams[..., :-1] == last_ngram_prefix[:, None]).all(-1)
+    if attention_mask is not None:
+        ngrams_are_repeated &= attention_mask.unfold(1, no_repeat_ngram_size, 1).all(-1)
+        ngrams_are_repeated &= attention_mask[:, seq_len - (no_repeat_ngram_size - 1) :].all(
+            -1, True
+        )
+    # The tokens we're not allowed to generate are the ends of those ngrams (we count matches, rather than writing
+    # booleans, since the same end token can appear in several ngrams)
+    n_banned = t.zeros_like(logprobs).scatter_add_(
+        1, ngrams[..., -1], ngrams_are_repeated.to(logprobs.dtype)
+    )
+    return logprobs.masked_fill(n_banned > 0, -1.0e10)
+
+
 @dataclass
 class Beams:
     """Class to store beams during beam search."""
@@ -1237,11 +3158,20 @@ class Beams:
     tokenizer: GPT2TokenizerFast
     logprob_sums: Float[Tensor, "batch"]
     tokens: Int[Tensor, "batch seq"]
+    # Optional cache of keys & values for all but the last token of each beam. Several beams can share a row of the
+    # cache (since they come from the same parent beam), so `cache_rows` says which row each beam uses
+    kv_cache: KeyValueCache | PagedKeyValueCache | None = None
+    cache_rows: Int[Tensor, "batch"] | None = None
 
     def __getitem__(self, batch_idx) -> "Beams":
         """Allows you to create new beams from old beams by slicing along batch dim (useful for `filter`)."""
         return Beams(
-            self.model, self.tokenizer, self.logprob_sums[batch_idx], self.tokens[batch_idx]
+            self.model,
+            self.tokenizer,
+            self.logprob_sums[batch_idx],
+            self.tokens[batch_idx],
+            self.kv_cache,
+            None if self.cache_rows is None else self.cache_rows[batch_idx],
         )
 
     @property
@@ -1260,8 +3190,18 @@ class Beams:
         Optional argument `no_repeat_ngram_size` means your model won't generate any sequences with a repeating n-gram
         of this length.
         """
-        # Get the output logprobs for the next token (for every sequence in current beams)
-        logprobs = self.model(self.tokens)[:, -1, :].log_softmax(-1)
+        # Get the output logprobs for the next token (for every sequence in current beams). If we have a cache, we
+        # first gather the cache rows for the current beams, then only run the model on the tokens not yet cached.
+        kv_cache = None
+        if self.kv_cache is not None and self.tokens.size(1) <= self.model.cfg.n_ctx:
+            cache_rows = self.cache_rows
+            if cache_rows is None:
+                cache_rows = t.arange(len(self.tokens), device=self.tokens.device)
+            kv_cache = self.kv_cache.select(cache_rows)
+            logits = self.model(self.tokens[:, kv_cache.seq_len :], kv_cache)
+        else:
+            logits = self.model(self.tokens)
+        logprobs = logits[:, -1, :].log_softmax(-1)
 
         # Get the top `toks_per_beam` tokens for each sequence
         topk_logprobs, topk_tokenIDs = self.get_topk_non_repeating(
@@ -1275,8 +3215,18 @@ class Beams:
             [einops.repeat(self.tokens, "b s -> b k s", k=k), topk_tokenIDs.unsqueeze(-1)], dim=-1
         )
 
+        # Each of the new beams continues from its parent's cache row
+        cache_rows = None
+        if kv_cache is not None:
+            cache_rows = t.arange(len(self.tokens), device=self.tokens.device).repeat_interleave(k)
+
         return Beams(
-            self.model, self.tokenizer, new_logprob_sums.flatten(), new_tokens.flatten(0, 1)
+            self.model,
+            self.tokenizer,
+            new_logprob_sums.flatten(),
+            new_tokens.flatten(0, 1),
+            kv_cache,
+            cache_rows,
         )
 
     def filter(self, k: int) -> tuple["Beams", "Beams"]:
@@ -1288,17 +3238,12 @@ class Beams:
                 filtered version of self, containing all best `k` which are also terminated.
         """
         # Get the indices of top `k` beams
-        top_beam_indices = self.logprob_sums.topk(k=k, dim=0).indices.tolist()
-        # Get the indices of terminated sequences
-        new_tokens = self.tokens[:, -1]
-        terminated_indices = t.nonzero(new_tokens == self.tokenizer.eos_token_id)
+        top_beam_indices = self.logprob_sums.topk(k=k, dim=0).indices
+        # Find which of them are terminated
+        is_terminated = self.tokens[top_beam_indices, -1] == self.tokenizer.eos_token_id
 
-        # Get the indices of the `k` best sequences (some terminated, some not terminated)
-        best_continuing = [i for i in top_beam_indices if i not in terminated_indices]
-        best_terminated = [i for i in top_beam_indices if i in terminated_indices]
-
-        # Return the beam objects from these indices
-        return self[best_continuing], self[best_terminated]
+        # Return the beam objects for the `k` best sequences (split into not terminated & terminated)
+        return self[top_beam_indices[~is_terminated]], self[top_beam_indices[is_terminated]]
 
     def get_topk_non_repeating(
         self,
@@ -1318,24 +3263,7 @@ class Beams:
             equivalent to the output of `logprobs.topk(dim=-1)`, but makes sure that no returned tokens would produce an
             ngram of size `no_repeat_ngram_size` which has already appeared in `self.tokens`.
         """
-        batch, seq_len = self.tokens.shape
-
-        # If completion isn't long enough for a repetition, or we have no restrictions, just return topk
-        if (no_repeat_ngram_size is not None) and (seq_len > no_repeat_ngram_size - 1):
-            # Otherwise, we need to check for ngram repetitions
-            # First, get the most recent `no_repeat_ngram_size-1` tokens
-            last_ngram_prefix = self.tokens[:, seq_len - (no_repeat_ngram_size - 1) :]
-            # Next, find all the tokens we're not allowed to generate, by checking all past ngrams for a match
-            for i in range(seq_len - (no_repeat_ngram_size - 1)):
-                ngrams = self.tokens[:, i : i + no_repeat_ngram_size]  # (batch, ngram)
-                ngrams_are_repeated = (ngrams[:, :-1] == last_ngram_prefix).all(-1)  # (batch,)
-                ngram_end_tokens = ngrams[:, [-1]]  # (batch, 1)
-                # Fill logprobs with neginf wherever the ngrams are repeated
-                logprobs[range(batch), ngram_end_tokens] = t.where(
-                    ngrams_are_repeated, -1.0e10, logprobs[range(batch), ngram_end_tokens]
-                )
-
-        # Finally, get our actual tokens
+        logprobs = ban_repeated_ngrams(logprobs, self.tokens, no_repeat_ngram_size)
         return logprobs.topk(k=k, dim=-1)
 
     def print(self, title="Best completions", max_print_chars=80) -> None:
@@ -1365,11 +3293,17 @@ def beam_search(
     num_beams: int,
     max_new_tokens: int,
     no_repeat_ngram_size: int | None = None,
+    use_cache: bool = True,
+    block_pool: BlockPool | None = None,
 ) -> list[tuple[float, str]]:
     """
     Implements a beam search, by repeatedly performing the `generate` and `filter` steps (starting from the initial
     prompt) until either of the two stopping criteria are met: (1) we've generated `max_new_tokens` tokens, or (2)
     we've generated `num_returns_sequences` terminating sequences.
+
+    If `use_cache` is True, beams carry a `KeyValueCache` which is reordered to follow them, so each step only runs the
+    model on the newest token of each beam. If `block_pool` is also given, the cache is a `PagedKeyValueCache` using
+    blocks from that pool, so beams share the blocks for their common prefix rather than each having a copy.
     """
     assert num_return_sequences <= num_beams
     self.model.eval()
@@ -1378,12 +3312,18 @@ def beam_search(
 
     final_logprobs_and_completions = []  # we add to this list as we get terminated beams
     best_beams = Beams(
-        self.model, self.tokenizer, t.tensor([0.0]).to(device), tokens
+        self.model,
+        self.tokenizer,
+        t.tensor([0.0]).to(device),
+        tokens,
+        (
+            None
+            if not use_cache
+            else KeyValueCache(self.cfg) if block_pool is None else PagedKeyValueCache(block_pool)
+        ),
     )  # start with just 1 beam
 
     for _ in tqdm(range(max_new_tokens)):
-        t.cuda.empty_cache()
-
         # Generate & filter beams
         best_beams = best_beams.generate(k=num_beams, no_repeat_ngram_size=no_repeat_ngram_size)
         best_beams, best_beams_terminated = best_beams.filter(k=num_beams)
@@ -1400,6 +3340,126 @@ def beam_search(
 
 TransformerSampler.beam_search = beam_search
 
+
+def beam_search_batch(
+    self: TransformerSampler,
+    prompts: list[str],
+    num_return_sequences: int,
+    num_beams: int,
+    max_new_tokens: int,
+    no_repeat_ngram_size: int | None = None,
+    length_penalty: float = 1.0,
+    early_stopping: bool = True,
+) -> list[list[tuple[float, str]]]:
+    """
+    Beam search over a batch of prompts at once. All `len(prompts) * num_beams` beams are kept in one tensor, with one
+    KV cache which is reordered to follow them at each step.
+
+    Finished sequences are scored by `logprob_sum / n_new_tokens ** length_penalty`, so `length_penalty=0` ranks by raw
+    logprob sums (like `beam_search`), and larger values favour longer sequences.
+
+    With `early_stopping`, a prompt is dropped from the batch as soon as it has `num_return_sequences` finished
+    sequences and no live beam can beat the worst of them. Logprob sums can only decrease, so the best score a live
+    beam could reach is its current logprob sum divided by the most favourable length it could still end at.
+
+    Returns a list with the best `num_return_sequences` (score, completion) pairs for each prompt, best first.
+    """
+    assert num_return_sequences <= num_beams
+    self.model.eval()
+    n_ctx, d_vocab = self.cfg.n_ctx, self.cfg.d_vocab
+    eos_token_id = self.tokenizer.eos_token_id
+
+    input_ids, attention_mask = self.encode_batch(prompts)
+    kv_cache = KeyValueCache(self.cfg)
+    # Logprob sums of the live beams for each active prompt, sorted best first (we start with 1 beam per prompt)
+    logprob_sums = t.zeros(len(prompts), 1, device=device)
+    # Indices of the prompts still being searched, and their best finished sequences as (score, tokens) pairs
+    active = list(range(len(prompts)))
+    finished = [[] for _ in prompts]
+
+    def add_finished(prompt_idx: int, score: float, tokens: Int[Tensor, "seq"]) -> None:
+        finished[prompt_idx].append((score, tokens))
+        finished[prompt_idx].sort(key=lambda x: x[0], reverse=True)
+        del finished[prompt_idx][num_return_sequences:]
+
+    for n_new_tokens in tqdm(range(1, max_new_tokens + 1)):
+        # Get the logprobs for the next token of every beam (we only need to run the uncached tokens through the model)
+        if kv_cache is not None and input_ids.size(1) <= n_ctx:
+            logits = self.model(input_ids[:, kv_cache.seq_len :], kv_cache, attention_mask)
+        else:
+            kv_cache = None
+            logits = self.model(input_ids[:, -n_ctx:], attention_mask=attention_mask[:, -n_ctx:])
+        logprobs = logits[:, -1].log_softmax(-1)
+        logprobs = ban_repeated_ngrams(logprobs, input_ids, no_repeat_ngram_size, attention_mask)
+
+        # Get the best `2 * num_beams` continuations for each prompt (at most one per beam can be terminated, so this
+        # leaves at least `num_beams` live ones). `parent_rows` are the rows of `input_ids` they continue from.
+        batch, n_beams = logprob_sums.shape
+        candidate_logprob_sums = logprob_sums[..., None] + logprobs.view(batch, n_beams, d_vocab)
+        candidate_logprob_sums, candidate_idx = candidate_logprob_sums.flatten(1).topk(
+            min(2 * num_beams, n_beams * d_vocab), dim=-1
+        )
+        parent_rows = candidate_idx // d_vocab + n_beams * t.arange(batch, device=device)[:, None]
+        candidate_tokens = candidate_idx % d_vocab
+        is_terminated = candidate_tokens == eos_token_id
+
+        # Terminated candidates which are among the top `num_beams` become finished sequences
+        for i, j in is_terminated[:, :num_beams].nonzero().tolist():
+            row = parent_rows[i, j]
+            tokens = t.cat([input_ids[row, attention_mask[row]], candidate_tokens[i, j, None]])
+            score = candidate_logprob_sums[i, j].item() / n_new_tokens**length_penalty
+            add_finished(active[i], score, tokens)
+
+        # The live beams are the best `num_beams` candidates which aren't terminated (a stable sort keeps their order)
+        live = is_terminated.int().argsort(dim=-1, stable=True)[:, :num_beams]
+        logprob_sums = candidate_logprob_sums.gather(1, live)
+        parent_rows = parent_rows.gather(1, live)
+        new_tokens = candidate_tokens.gather(1, live)
+
+        # Drop prompts whose worst kept finished sequence can't be beaten by any live beam
+        keep = list(range(batch))
+        if early_stopping:
+            best_length = max_new_tokens if length_penalty > 0 else n_new_tokens
+            best_possible_scores = (logprob_sums[:, 0] / best_length**length_penalty).tolist()
+            keep = [
+                i
+                for i in keep
+                if len(finished[active[i]]) < num_return_sequences
+                or finished[active[i]][-1][0] < best_possible_scores[i]
+            ]
+            if len(keep) < batch:
+                active = [active[i] for i in keep]
+                keep = t.tensor(keep, dtype=t.long, device=device)
+                logprob_sums, parent_rows, new_tokens = (
+                    logprob_sums[keep],
+                    parent_rows[keep],
+                    new_tokens[keep],
+                )
+                if not active:
+                    break
+
+        # Reorder the beams (and their cache) to follow the parents of the new beams, then add the new tokens
+        parent_rows = parent_rows.flatten()
+        input_ids = t.cat([input_ids[parent_rows], new_tokens.flatten()[:, None]], dim=-1)
+        attention_mask = F.pad(attention_mask[parent_rows], (0, 1), value=True)
+        if kv_cache is not None:
+            kv_cache = kv_cache.select(parent_rows)
+
+    # Any prompts still active when we run out of tokens also consider their live beams as finished sequences
+    for i, prompt_idx in enumerate(active):
+        for j in range(logprob_sums.size(1)):
+            row = i * logprob_sums.size(1) + j
+            score = logprob_sums[i, j].item() / max_new_tokens**length_penalty
+            add_finished(prompt_idx, score, input_ids[row, attention_mask[row]])
+
+    return [
+        [(score, self.tokenizer.decode(tokens)) for score, tokens in prompt_finished]
+        for prompt_finished in finished
+    ]
+
+
+TransformerSampler.beam_search_batch = beam_search_batch
+
 # %%
 
 if MAIN:
@@ -1501,4 +3561,602 @@ if MAIN:
             f"Avg token prob = {avg_logprob_as_prob:.3f}\nBest output:\n[bold dark_orange]{text}"
         )
 
-# %%
\ No newline at end of file
+# %%
+
+if MAIN:
+    # Time the same 40-beam search with and without the KV cache (the outputs should match)
+    beam_search_kwargs = dict(
+        prompt=prompt,
+        num_return_sequences=3,
+        num_beams=40,
+        max_new_tokens=60,
+        no_repeat_ngram_size=2,
+    )
+    beam_search_results = {}
+    for use_cache in [False, True]:
+        start = time.perf_counter()
+        beam_search_results[use_cache] = sampler.beam_search(
+            **beam_search_kwargs, use_cache=use_cache
+        )
+        print(f"use_cache={use_cache}: {time.perf_counter() - start:.1f}s")
+
+    assert [text for _, text in beam_search_results[False]] == [
+        text for _, text in beam_search_results[True]
+    ]
+
+# %%
+
+if MAIN:
+    # Beam search over several prompts at once, with length normalization. Early stopping shouldn't change the results
+    # (it only drops prompts which can't improve), but it should save steps.
+    prompts = [
+        "The ships hung in the sky in much the same way that",
+        "When I was",
+        "In summary, the main finding of the paper is",
+    ]
+    beam_search_kwargs = dict(
+        num_return_sequences=3,
+        num_beams=10,
+        max_new_tokens=40,
+        no_repeat_ngram_size=2,
+        length_penalty=1.0,
+    )
+    results = {}
+    for early_stopping in [False, True]:
+        start = time.perf_counter()
+        results[early_stopping] = sampler.beam_search_batch(
+            prompts, **beam_search_kwargs, early_stopping=early_stopping
+        )
+        print(f"early_stopping={early_stopping}: {time.perf_counter() - start:.1f}s")
+
+    for prompt_results, prompt_results_no_early_stopping in zip(results[True], results[False]):
+        assert [text for _, text in prompt_results] == [
+            text for _, text in prompt_results_no_early_stopping
+        ]
+        for score, text in prompt_results:
+            rprint(f"Score = {score:.3f}\n[bold dark_orange]{text}")
+
+# %%
+
+if MAIN:
+    # With a paged cache, beams share the blocks of their common prefix (copying a block only when they write into it),
+    # whereas a contiguous cache holds a full copy of the prefix for every beam
+    block_pool = BlockPool(model.cfg, num_blocks=2048, block_size=16)
+    prompt = "The ships hung in the sky in much the same way that"
+    paged_results = sampler.beam_search(
+        prompt=prompt,
+        num_return_sequences=3,
+        num_beams=40,
+        max_new_tokens=60,
+        no_repeat_ngram_size=2,
+        block_pool=block_pool,
+    )
+    assert [text for _, text in paged_results] == [text for _, text in beam_search_results[True]]
+    contiguous_positions = 40 * (len(tokenizer.encode(prompt)) + 60)
+    paged_positions = block_pool.peak_used_blocks * block_pool.block_size
+    print(
+        f"Beam search: peak positions cached = {paged_positions} (paged) vs {contiguous_positions} (contiguous)"
+    )
+
+    # Serving: how many sequences fit in a fixed memory budget? A contiguous cache needs each sequence's maximum length
+    # reserving up front, whereas paging only allocates blocks as they're needed
+    # (we only simulate the allocations, so the pool is on the meta device and takes no memory)
+    budget_bytes = 2**30
+    bytes_per_position = 2 * model.cfg.n_layers * model.cfg.n_heads * model.cfg.d_head * 4
+    num_blocks = budget_bytes // (16 * bytes_per_position)
+    block_pool = BlockPool(model.cfg, num_blocks=num_blocks, block_size=16, device="meta")
+    rng = np.random.default_rng(0)
+    caches, n_positions = [], 0
+    while True:
+        seq_len = int(rng.integers(16, model.cfg.n_ctx))
+        cache = PagedKeyValueCache(block_pool)
+        try:
+            cache.append_slots(seq_len)
+        except RuntimeError:
+            cache.free()
+            break
+        caches.append(cache)
+        n_positions += seq_len
+    n_contiguous = budget_bytes // (model.cfg.n_ctx * bytes_per_position)
+    print(
+        f"1 GiB budget: {len(caches)} sequences, {n_positions / (block_pool.num_used_blocks * 16):.1%} of cache memory "
+        f"used (paged) vs {n_contiguous} sequences, {n_positions / len(caches) / model.cfg.n_ctx:.1%} used (contiguous)"
+    )
+
+# %%
+
+
+class SpeculativeSampler:
+    """
+    Speculative decoding: a small draft model proposes `num_draft_tokens` tokens one at a time, and the main model
+    scores all of them in a single forward pass.
+
+    Each draft token x is accepted with probability min(1, p(x) / q(x)), where p and q are the main and draft models'
+    distributions. At the first rejection we sample from the normalized residual max(0, p - q) instead, and if every
+    draft token is accepted we also get a free token from the main model's last position. The output has exactly the
+    same distribution as `TransformerSampler.sample` with the main model, but that model only runs once per
+    (accepted tokens + 1) new tokens.
+    """
+
+    def __init__(
+        self,
+        model: DemoTransformer,
+        draft_model: DemoTransformer,
+        tokenizer: GPT2TokenizerFast,
+        num_draft_tokens: int = 4,
+    ):
+        assert model.cfg.d_vocab == draft_model.cfg.d_vocab, "Models must share a vocabulary"
+        self.model = model
+        self.draft_model = draft_model
+        self.tokenizer = tokenizer
+        self.num_draft_tokens = num_draft_tokens
+        # Number of draft tokens accepted at each step of the most recent call to `sample`
+        self.accepted_per_step: list[int] = []
+
+    @t.inference_mode()
+    def sample(
+        self,
+        prompt: str,
+        max_tokens_generated=100,
+        temperature=1.0,
+        top_k=0,
+        top_p=0.0,
+        seed=None,
+        generator: t.Generator | None = None,
+    ) -> str:
+        """
+        Returns a string of autoregressively generated text, starting from the prompt. Takes the same arguments as
+        `TransformerSampler.sample` (except for the frequency penalty, which isn't supported).
+        """
+        self.model.eval()
+        self.draft_model.eval()
+        if generator is None and seed is not None:
+            generator = TransformerSampler.make_generator(seed)
+        sampling_kwargs = dict(temperature=temperature, top_k=top_k, top_p=top_p)
+        eos_token_id = getattr(self.tokenizer, "eos_token_id", None)
+        n_ctx = min(self.model.cfg.n_ctx, self.draft_model.cfg.n_ctx)
+
+        input_ids = self.tokenizer.encode(prompt, return_tensors="pt").to(device)[0]
+        n_prompt_tokens = len(input_ids)
+        kv_cache = KeyValueCache(self.model.cfg)
+        draft_kv_cache = KeyValueCache(self.draft_model.cfg)
+        self.accepted_per_step = []
+
+        while (n_tokens_left := max_tokens_generated - (len(input_ids) - n_prompt_tokens)) > 0:
+            # Draft as many tokens as we can, leaving room for the main model's token
+            k = min(self.num_draft_tokens, n_tokens_left - 1)
+            if len(input_ids) + k > n_ctx:
+                # We can't use the caches past the context length, so finish off with the main model alone
+                new_tokens = TransformerSampler(self.model, self.tokenizer).generate_token_ids(
+                    input_ids, n_tokens_left, generator=generator, **sampling_kwargs
+                )
+                input_ids = t.cat([input_ids, t.tensor(list(new_tokens), device=device)])
+                break
+
+            # Draft `k` tokens with the small model (its cache can be a token behind, so we pass in all uncached tokens)
+            candidate_ids = input_ids
+            draft_probs = []
+            for _ in range(k):
+                logits = self.draft_model(
+                    candidate_ids[None, draft_kv_cache.seq_len :], draft_kv_cache
+                )
+                probs = TransformerSampler.get_probs(logits[:, -1], **sampling_kwargs)[0]
+                draft_token = t.multinomial(probs, 1, generator=generator)
+                candidate_ids = t.cat([candidate_ids, draft_token])
+                draft_probs.append(probs)
+
+            # Get the main model's distributions at every draft position, plus the one after the last draft token
+            logits = self.model(candidate_ids[None, kv_cache.seq_len :], kv_cache)
+            probs = TransformerSampler.get_probs(logits[0, -(k + 1) :], **sampling_kwargs)
+
+            # Accept each draft token with probability min(1, p/q), up to the first rejection
+            n_accepted = 0
+            if k > 0:
+                draft_probs = t.stack(draft_probs)
+                draft_tokens = candidate_ids[len(input_ids) :, None]
+                p, q = probs[:k].gather(1, draft_tokens), draft_probs.gather(1, draft_tokens)
+                u = t.rand(k, 1, generator=generator, device=device)
+                n_accepted = int((u * q < p).squeeze(1).cumprod(0).sum().item())
+
+            # The next token comes from the residual distribution at the first rejection, or from the main model's
+            # distribution after the last draft token if they were all accepted
+            if n_accepted < k:
+                next_probs = (probs[n_accepted] - draft_probs[n_accepted]).clamp(min=0)
+                if next_probs.sum() <= 0:
+                    next_probs = probs[n_accepted]
+            else:
+                next_probs = probs[k]
+            next_token = t.multinomial(next_probs, 1, generator=generator)
+
+            # Keep the accepted tokens, and drop the rejected ones from both caches
+            input_ids = t.cat([candidate_ids[: len(input_ids) + n_accepted], next_token])
+            kv_cache.truncate(len(input_ids) - 1)
+            draft_kv_cache.truncate(len(input_ids) - 1)
+            self.accepted_per_step.append(n_accepted)
+
+            # If we generated the end-of-text token, stop (dropping anything after it)
+            new_tokens = input_ids[-(n_accepted + 1) :]
+            if eos_token_id is not None and (new_tokens == eos_token_id).any():
+                eos_idx = (new_tokens == eos_token_id).nonzero()[0].item()
+                input_ids = input_ids[: len(input_ids) - len(new_tokens) + eos_idx + 1]
+                break
+
+        return self.tokenizer.decode(input_ids)
+
+
+# %%
+
+if MAIN:
+    # Use the small model we trained above as a draft model for GPT-2. Greedy decoding should give exactly the same
+    # output as sampling from GPT-2 alone, and every accepted draft token saves a forward pass of GPT-2.
+    draft_model = trainer.model
+    speculative_sampler = SpeculativeSampler(model, draft_model, tokenizer, num_draft_tokens=4)
+    prompt = "Once upon a time, there was a little girl named Lily. She"
+
+    for kwargs in [dict(temperature=0.0), dict(temperature=1.0, top_p=0.9, seed=0)]:
+        start = time.perf_counter()
+        output = sampler.sample(prompt, max_tokens_generated=64, **kwargs)
+        time_baseline = time.perf_counter() - start
+
+        start = time.perf_counter()
+        speculative_output = speculative_sampler.sample(prompt, max_tokens_generated=64, **kwargs)
+        time_speculative = time.perf_counter() - start
+
+        accepted_per_step = np.mean(speculative_sampler.accepted_per_step)
+        print(
+            f"{kwargs}: accepted draft tokens per step = {accepted_per_step:.2f}, "
+            f"speedup = {time_baseline / time_speculative:.2f}x"
+        )
+        if kwargs["temperature"] == 0.0:
+            assert speculative_output == output
+
+# %%
+
+
+# The dimensions each weight matrix is summed over in its module's forward pass. Int8 scales are per output channel, so
+# they're taken over these dimensions. `W_E` is indexed rather than multiplied, so it gets a scale per token.
+INT8_REDUCE_DIMS = {
+    "W_Q": (1,),
+    "W_K": (1,),
+    "W_V": (1,),
+    "W_O": (0, 1),
+    "W_in": (0,),
+    "W_out": (0,),
+    "W_E": (1,),
+    "W_U": (0,),
+}
+
+
+def quantize_int8(
+    weight: Float[Tensor, "..."], dims: tuple[int, ...]
+) -> tuple[Int[Tensor, "..."], Float[Tensor, "..."]]:
+    """
+    Symmetric int8 quantization of `weight`, with one scale for every slice along `dims`. Returns the int8 weight and
+    the scales (with size 1 along `dims`), such that `weight ≈ weight_int8 * scale`.
+    """
+    scale = weight.abs().amax(dim=dims, keepdim=True).clamp(min=1e-12) / 127
+    weight_int8 = (weight / scale).round().clamp(-127, 127).to(t.int8)
+    return weight_int8, scale
+
+
+def dequantize_weights_hook(module: nn.Module, args: tuple) -> tuple | None:
+    """
+    Forward pre-hook which dequantizes the module's int8 weights into plain fp32 attributes, so the module's forward
+    pass runs unchanged. `Embed` only dequantizes the rows for the tokens it's looking up.
+    """
+    for name in module.quantized_weights:
+        weight_int8, scale = getattr(module, f"{name}_int8"), getattr(module, f"{name}_scale")
+        if isinstance(module, Embed):
+            unique_tokens, tokens = args[0].unique(return_inverse=True)
+            weight_int8, scale = weight_int8[unique_tokens], scale[unique_tokens]
+            args = (tokens, *args[1:])
+        setattr(module, name, weight_int8.to(scale.dtype).mul_(scale))
+    return args
+
+
+def free_weights_hook(module: nn.Module, args: tuple, output: Tensor) -> None:
+    """Forward hook which drops the fp32 weights made by `dequantize_weights_hook`."""
+    for name in module.quantized_weights:
+        delattr(module, name)
+    if isinstance(module, Attention):
+        module._packed_qkv = None
+
+
+def quantize(model: nn.Module, scheme: str = "int8_weight_only") -> nn.Module:
+    """
+    Quantizes the weight matrices of every `Attention`, `MLP`, `Embed` and `Unembed` in `model` in place, and returns
+    the model (which is only fit for inference afterwards). Biases, layer norms and `W_pos` stay in fp32.
+
+    With `scheme="int8_weight_only"`, each weight is stored in int8 with an fp32 scale per output channel, and is
+    dequantized just before its module runs, so only one module's weights are in fp32 at any time. Each weight
+    parameter `W` is replaced by `W_int8` and `W_scale` buffers, so load any pretrained weights before quantizing.
+    """
+    if scheme != "int8_weight_only":
+        raise ValueError(f"Unknown quantization scheme {scheme!r}")
+    for module in model.modules():
+        if not isinstance(module, (Attention, MLP, Embed, Unembed)):
+            continue
+        if hasattr(module, "quantized_weights"):
+            continue
+        module.quantized_weights = []
+        for name, dims in INT8_REDUCE_DIMS.items():
+            if name not in module._parameters:
+                continue
+            weight_int8, scale = quantize_int8(module._parameters.pop(name).detach(), dims)
+            module.register_buffer(f"{name}_int8", weight_int8)
+            module.register_buffer(f"{name}_scale", scale)
+            module.quantized_weights.append(name)
+        module.register_forward_pre_hook(dequantize_weights_hook)
+        module.register_forward_hook(free_weights_hook)
+    return model
+
+
+# %%
+
+if MAIN:
+    # Quantize a copy of GPT-2 small, and compare the size of the weights, the decoding speed on CPU, and the
+    # perplexity on the held-out stories
+    def model_size_mb(model: nn.Module) -> float:
+        tensors = itertools.chain(model.parameters(), model.buffers())
+        return sum(tensor.nbytes for tensor in tensors) / 2**20
+
+    models = {"fp32": model.cpu()}
+    models["int8"] = quantize(copy.deepcopy(models["fp32"]), scheme="int8_weight_only")
+    held_out_tokens = validation_dataset[:64]["tokens"]
+    prompt = "Once upon a time, there was a little girl named Lily. She"
+
+    table = Table("weights", "size (MB)", "tokens/s", "perplexity", title="int8 weight-only, CPU")
+    with t.inference_mode():
+        for name, quantized_model in models.items():
+            quantized_sampler = TransformerSampler(quantized_model, tokenizer)
+            start = time.perf_counter()
+            quantized_sampler.sample(prompt, max_tokens_generated=32, temperature=0.0)
+            tokens_per_second = 32 / (time.perf_counter() - start)
+            log_probs = t.cat(
+                [get_log_probs(quantized_model(batch), batch) for batch in held_out_tokens.split(8)]
+            )
+            table.add_row(
+                name,
+                f"{model_size_mb(quantized_model):.0f}",
+                f"{tokens_per_second:.1f}",
+                f"{(-log_probs.mean()).exp():.3f}",
+            )
+    rprint(table)
+    model.to(device)
+
+# %%
+
+
+class CompiledTransformer(nn.Module):
+    """
+    Runs a `DemoTransformer` with its forward pass compiled by `torch.compile`, for training, scoring and decoding. Use
+    it in place of the model (parameters are shared with it, so e.g. an optimizer on either updates both). Only the
+    model itself is a submodule, so the state dict & parameters are the same as the model's, with a "model." prefix.
+    `normalized_resid_final` is compiled too, and `unembed` is the model's own, for chunked scoring & losses.
+
+    Compiled graphs are specialized to input shapes, so to bound the number of compilations:
+        - Batch sizes (without a cache) and sequence lengths are padded up to the next bucket. Padding positions on
+          the right is exact, since earlier positions can't attend to them, and padding rows are independent.
+        - Cache lengths are marked as dynamic, so a single graph serves every decode step.
+
+    Decode steps for batches of at most `eager_decode_batch_size` run eagerly: with a single row they're dominated by
+    matrix-vector products, which the compiled graph runs slower than eager mode (about 2x on CPU for GPT-2 small).
+
+    If `cache_path` is given and exists, compiled artifacts saved by an earlier `warmup` are loaded from it, so a new
+    process doesn't have to compile from scratch.
+    """
+
+    def __init__(
+        self,
+        model: DemoTransformer,
+        mode: str | None = None,
+        batch_size_buckets: tuple[int, ...] = (1, 2, 4, 8, 16, 32, 64),
+        seq_len_buckets: tuple[int, ...] | None = None,
+        cache_path: str | Path | None = None,
+        eager_decode_batch_size: int = 1,
+    ):
+        super().__init__()
+        self.model = model
+        self.cfg = model.cfg
+        self.batch_size_buckets = batch_size_buckets
+        if seq_len_buckets is None:
+            seq_len_buckets = tuple(2**i for i in range(4, int(math.log2(self.cfg.n_ctx)) + 1))
+        self.seq_len_buckets = tuple(sorted({*seq_len_buckets, self.cfg.n_ctx}))
+        self.cache_path = None if cache_path is None else Path(cache_path)
+        self.eager_decode_batch_size = eager_decode_batch_size
+        if self.cache_path is not None and self.cache_path.exists():
+            t.compiler.load_cache_artifacts(self.cache_path.read_bytes())
+        # Each bucket (and full forward / prefill / decode, with or without gradients) is its own graph, which is more
+        # than Dynamo's default limit before it gives up and runs eagerly. We only raise the limit while calling our
+        # compiled forward, rather than for the whole process.
+        n_graphs = 6 * len(self.batch_size_buckets) * len(self.seq_len_buckets)
+        self.recompile_limit = max(t._dynamo.config.recompile_limit, n_graphs)
+        # Compiling the bound method rather than the module means the compiled callable isn't registered as a second
+        # submodule holding the same parameters
+        self.compiled_forward = t.compile(model.forward, mode=mode, dynamic=False)
+        self.compiled_normalized_resid_final = t.compile(
+            model.normalized_resid_final, mode=mode, dynamic=False
+        )
+
+    @staticmethod
+    def bucket(size: int, buckets: tuple[int, ...]) -> int:
+        """Returns the smallest bucket that fits `size` (or `size` itself, if it's larger than every bucket)."""
+        return next((bucket for bucket in buckets if bucket >= size), size)
+
+    @staticmethod
+    def with_standard_strides(x: Tensor) -> Tensor:
+        """
+        Returns `x` with the strides of a new tensor of its shape, copying it if needed. Unlike `Tensor.contiguous`, this
+        also fixes the strides of size 1 dimensions, which compiled graphs are specialized to as well.
+        """
+        if x.stride() == t.empty(0, device="meta").new_empty(x.shape).stride():
+            return x
+        return x.clone(memory_format=t.contiguous_format)
+
+    def forward(
+        self,
+        tokens: Int[Tensor, "batch position"],
+        kv_cache: KeyValueCache | None = None,
+        attention_mask: Bool[Tensor, "batch posn_K"] | None = None,
+        segment_ids: Int[Tensor, "batch position"] | None = None,
+    ) -> Float[Tensor, "batch position d_vocab"]:
+        """Same as `DemoTransformer.forward`."""
+        return self.run_padded(
+            self.compiled_forward, self.model.forward, tokens, kv_cache, attention_mask, segment_ids
+        )
+
+    def normalized_resid_final(
+        self,
+        tokens: Int[Tensor, "batch position"],
+        kv_cache: KeyValueCache | None = None,
+        attention_mask: Bool[Tensor, "batch posn_K"] | None = None,
+        segment_ids: Int[Tensor, "batch position"] | None = None,
+    ) -> Float[Tensor, "batch position d_model"]:
+        """Same as `DemoTransformer.normalized_resid_final`."""
+        return self.run_padded(
+            self.compiled_normalized_resid_final,
+            self.model.normalized_resid_final,
+            tokens,
+            kv_cache,
+            attention_mask,
+            segment_ids,
+        )
+
+    @property
+    def unembed(self) -> Unembed:
+        """The model's unembedding, which is cheap enough to run eagerly on chunks of `normalized_resid_final`."""
+        return self.model.unembed
+
+    def run_padded(
+        self,
+        compiled_fn: Callable,
+        eager_fn: Callable,
+        tokens: Int[Tensor, "batch position"],
+        kv_cache: KeyValueCache | None,
+        attention_mask: Bool[Tensor, "batch posn_K"] | None,
+        segment_ids: Int[Tensor, "batch position"] | None,
+    ) -> Float[Tensor, "batch position ..."]:
+        """
+        Calls `compiled_fn` on the inputs padded up to their buckets, and returns its output for the unpadded positions
+        (or calls `eager_fn` on the unpadded inputs, for caches & decode steps we don't compile).
+        """
+        if kv_cache is not None and not isinstance(kv_cache, KeyValueCache):
+            # Other caches (e.g. `PagedKeyValueCache`) do too much in Python to trace, so we run them eagerly
+            return eager_fn(tokens, kv_cache, attention_mask, segment_ids)
+
+        batch, seq_len = tokens.shape
+        if kv_cache is not None and seq_len == 1 and batch <= self.eager_decode_batch_size:
+            return eager_fn(tokens, kv_cache, attention_mask, segment_ids)
+        offset = 0 if kv_cache is None else kv_cache.seq_len
+        # A cache holds one row per sequence, so only pad the batch without one. Single-token decode steps don't need
+        # padding either, and we can't pad past the context length.
+        padded_batch = (
+            batch if kv_cache is not None else self.bucket(batch, self.batch_size_buckets)
+        )
+        padded_seq_len = seq_len
+        if kv_cache is None or seq_len > 1:
+            padded_seq_len = min(
+                self.bucket(seq_len, self.seq_len_buckets), self.cfg.n_ctx - offset
+            )
+        padded_seq_len = max(padded_seq_len, seq_len)
+
+        # Samplers pass in slices of growing tensors, whose strides would also trigger recompiles
+        tokens = self.with_standard_strides(tokens)
+        if attention_mask is not None:
+            attention_mask = self.with_standard_strides(attention_mask)
+        if segment_ids is not None:
+            segment_ids = self.with_standard_strides(segment_ids)
+        if (padded_batch, padded_seq_len) != (batch, seq_len):
+            padding = (0, padded_seq_len - seq_len, 0, padded_batch - batch)
+            tokens = F.pad(tokens, padding)
+            if attention_mask is not None:
+                attention_mask = F.pad(attention_mask, padding, value=False)
+            if segment_ids is not None:
+                # Any segment id is exact here, since padding is on the right (or in rows of its own)
+                segment_ids = F.pad(segment_ids, padding)
+        if offset >= 2:
+            # Sizes of 0 or 1 are always specialized, so only longer caches can be marked as dynamic. Truncated caches
+            # are views with different strides (which would also recompile), so they're copied first.
+            for entry in kv_cache.entries:
+                entry.k, entry.v = self.with_standard_strides(entry.k), self.with_standard_strides(
+                    entry.v
+                )
+                t._dynamo.mark_dynamic(entry.k, 1)
+                t._dynamo.mark_dynamic(entry.v, 1)
+            if attention_mask is not None:
+                t._dynamo.mark_dynamic(attention_mask, 1)
+
+        with t._dynamo.config.patch(recompile_limit=self.recompile_limit):
+            out = compiled_fn(tokens, kv_cache, attention_mask, segment_ids)
+        if kv_cache is not None and padded_seq_len != seq_len:
+            kv_cache.truncate(offset + seq_len)
+        return out[:batch, :seq_len]
+
+    def warmup(self, batch_sizes: tuple[int, ...] = (1,), seq_lens: tuple[int, ...] = ()) -> None:
+        """
+        Compiles the inference graphs for each batch size and each sequence length (defaulting to every bucket): a full
+        forward pass, and a cached prefill followed by decode steps. Then saves the compiled artifacts to
+        `cache_path`, if it's set.
+        """
+        with t.inference_mode():
+            for batch_size in batch_sizes:
+                for seq_len in seq_lens or self.seq_len_buckets:
+                    tokens = t.zeros((batch_size, seq_len), dtype=t.long, device=device)
+                    self(tokens)
+                    kv_cache = KeyValueCache(self.cfg)
+                    self(tokens, kv_cache)
+                    for _ in range(min(2, self.cfg.n_ctx - seq_len)):
+                        self(tokens[:, :1], kv_cache)
+        if self.cache_path is not None:
+            artifacts = t.compiler.save_cache_artifacts()
+            if artifacts is not None:
+                self.cache_path.parent.mkdir(parents=True, exist_ok=True)
+                self.cache_path.write_bytes(artifacts[0])
+
+
+def compile_model(model: DemoTransformer, mode: str | None = None, **kwargs) -> CompiledTransformer:
+    """
+    Returns `model` with its forward pass compiled (see `CompiledTransformer` for the keyword arguments). `mode` is
+    passed to `torch.compile`, e.g. "reduce-overhead" or "max-autotune".
+    """
+    return CompiledTransformer(model, mode=mode, **kwargs)
+
+
+# %%
+
+if MAIN:
+    # Compare eager and compiled GPT-2 small on CPU, for a full forward pass over 64 tokens and a single decode step
+    # after them, at batch sizes 1 and 32
+    model = model.cpu().eval()
+    compiled_model = compile_model(model, cache_path="data/compile_cache.bin")
+    start = time.perf_counter()
+    compiled_model.warmup(batch_sizes=(1, 32), seq_lens=(64,))
+    print(
+        f"Compiled in {time.perf_counter() - start:.1f}s (a second run loads data/compile_cache.bin)"
+    )
+
+    table = Table(
+        "batch", "step", "eager (ms)", "compiled (ms)", "speedup", title="GPT-2 small on CPU"
+    )
+    with t.inference_mode():
+        for batch_size in [1, 32]:
+            tokens = t.randint(0, model.cfg.d_vocab, (batch_size, 64))
+            next_tokens = t.randint(0, model.cfg.d_vocab, (batch_size, 1))
+            times = {}
+            for name, timed_model in [("eager", model), ("compiled", compiled_model)]:
+                kv_cache = KeyValueCache(model.cfg)
+                timed_model(tokens, kv_cache)
+                times[name, "forward"] = benchmark(lambda: timed_model(tokens), n_iters=5)
+                times[name, "decode"] = benchmark(
+                    lambda: (timed_model(next_tokens, kv_cache), kv_cache.truncate(64)), n_iters=20
+                )
+            for step in ["forward", "decode"]:
+                table.add_row(
+                    str(batch_size),
+                    step,
+                    f"{times['eager', step] * 1e3:.1f}",
+                    f"{times['compiled', step] * 1e3:.1f}",
+                    f"{times['eager', step] / times['compiled', step]:.2f}x",
+                )
+    rprint(table)
+    model.to(device)
\ No newline at end of file
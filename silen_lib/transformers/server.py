@@ -0,0 +1,379 @@
+"""
+Continuous-batching inference server for `DemoTransformer`.
+
+Requests are queued as they arrive, and one scheduler loop decodes a single token for every running sequence per step.
+Between steps it evicts sequences which have finished and admits new ones from the queue (up to `max_batch_size`), so
+short requests never wait for a whole batch of long ones to finish.
+
+Run with `python -m silen_lib.transformers.server`, then POST JSON like {"prompt": "...", "max_tokens_generated": 50}
+to /generate, or GET /metrics. See `scripts/benchmark-server.py` for a load generator.
+"""
+
+import argparse
+import asyncio
+import json
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from functools import partial
+from http import HTTPStatus
+
+import torch as t
+import torch.nn.functional as F
+from jaxtyping import Bool, Int
+from torch import Tensor
+from transformers.models.gpt2.tokenization_gpt2_fast import GPT2TokenizerFast
+
+from silen_lib.transformers.main import (
+    Config,
+    DemoTransformer,
+    KeyValueCache,
+    TransformerSampler,
+    device,
+)
+
+
+@dataclass
+class GenerationRequest:
+    prompt: str
+    max_tokens_generated: int = 100
+    temperature: float = 1.0
+    top_k: int = 0
+    top_p: float = 0.0
+    frequency_penalty: float = 0.0
+    seed: int | None = None
+
+    def __post_init__(self):
+        if self.max_tokens_generated < 1:
+            raise ValueError("max_tokens_generated must be at least 1")
+        if self.temperature < 0:
+            raise ValueError("Temperature should be non-negative")
+        if not 0 <= self.top_p <= 1.0:
+            raise ValueError("Top-p must be a probability")
+        if self.top_k < 0:
+            raise ValueError("Top-k must be non-negative")
+        if self.top_p != 0 and self.top_k != 0:
+            raise ValueError("At most one of top-p and top-k supported")
+
+
+@dataclass
+class Sequence:
+    """A request which is queued or being decoded, along with the state the scheduler keeps for it."""
+
+    request: GenerationRequest
+    prompt_ids: list[int]
+    future: asyncio.Future
+    generator: t.Generator
+    arrival_time: float = field(default_factory=time.perf_counter)
+    first_token_time: float | None = None
+    new_token_ids: list[int] = field(default_factory=list)
+
+
+def left_pad(x: Tensor, length: int, value=0) -> Tensor:
+    """Left-pads dimension 1 of `x` (the sequence dimension, for token ids, masks and cached keys & values)."""
+    return F.pad(x, [0, 0] * (x.ndim - 2) + [length - x.size(1), 0], value=value)
+
+
+class ContinuousBatchingScheduler:
+    """
+    Runs every admitted sequence in one decode batch. Rows are left-padded so they all end at the same position, and
+    padding is masked out of attention (so each row's positions and outputs are the same as if it was decoded alone).
+
+    Each sequence's keys & values are computed once when it's admitted (from its prompt) and then live in its row of
+    the batch cache, until it finishes and its row is dropped.
+    """
+
+    def __init__(
+        self,
+        model: DemoTransformer,
+        tokenizer: GPT2TokenizerFast,
+        max_batch_size: int = 32,
+        metrics_window: float = 5.0,
+    ):
+        self.model = model.eval()
+        self.cfg = model.cfg
+        self.tokenizer = tokenizer
+        self.eos_token_id = getattr(tokenizer, "eos_token_id", None)
+        self.pad_token_id = self.eos_token_id if self.eos_token_id is not None else 0
+        self.max_batch_size = max_batch_size
+        self.metrics_window = metrics_window
+
+        self.queue: asyncio.Queue[Sequence] = asyncio.Queue()
+        self.running: list[Sequence] = []
+        # Decode state for the running sequences: token ids & attention mask (True for real tokens), and a cache with
+        # the keys & values for all but the last column
+        self.input_ids: Int[Tensor, "batch seq"] | None = None
+        self.attention_mask: Bool[Tensor, "batch seq"] | None = None
+        self.kv_cache: KeyValueCache | None = None
+
+        # (time, batch size) for each recent step, used for the tokens/s metric
+        self.step_history: deque[tuple[float, int]] = deque()
+        self.n_tokens_generated = 0
+        self.n_requests_finished = 0
+
+    async def generate(self, request: GenerationRequest) -> dict:
+        """Queues a request, and returns its completion once the scheduler has finished it."""
+        # Keep the end of prompts which are too long (like `TransformerSampler`), leaving room for at least 1 token. An
+        # empty prompt starts from the padding token (end-of-text for GPT-2, which is how its documents start).
+        prompt_ids = self.tokenizer.encode(request.prompt)[-(self.cfg.n_ctx - 1) :]
+        prompt_ids = prompt_ids or [self.pad_token_id]
+        generator = t.Generator(device=device)
+        if request.seed is None:
+            generator.seed()
+        else:
+            generator.manual_seed(request.seed)
+        seq = Sequence(request, prompt_ids, asyncio.get_running_loop().create_future(), generator)
+        await self.queue.put(seq)
+        await seq.future
+
+        finish_time = time.perf_counter()
+        return {
+            "text": self.tokenizer.decode(seq.prompt_ids + seq.new_token_ids),
+            "n_tokens": len(seq.new_token_ids),
+            "time_to_first_token": seq.first_token_time - seq.arrival_time,
+            "latency": finish_time - seq.arrival_time,
+        }
+
+    def metrics(self) -> dict:
+        """Current queue depth & batch size, and tokens generated per second over the last `metrics_window` seconds."""
+        now = time.perf_counter()
+        while self.step_history and self.step_history[0][0] < now - self.metrics_window:
+            self.step_history.popleft()
+        return {
+            "queue_depth": self.queue.qsize(),
+            "batch_size": len(self.running),
+            "tokens_per_second": sum(n for _, n in self.step_history) / self.metrics_window,
+            "n_tokens_generated": self.n_tokens_generated,
+            "n_requests_finished": self.n_requests_finished,
+        }
+
+    async def run(self) -> None:
+        """Scheduler loop: admit waiting requests, run a decode step, and return any finished sequences."""
+        while True:
+            new_sequences = []
+            if not self.running:
+                new_sequences.append(await self.queue.get())
+            while len(self.running) + len(new_sequences) < self.max_batch_size:
+                try:
+                    new_sequences.append(self.queue.get_nowait())
+                except asyncio.QueueEmpty:
+                    break
+
+            # Run the model in a worker thread, so the event loop can keep accepting requests
+            try:
+                finished = await asyncio.to_thread(self.step, new_sequences)
+            except Exception as e:
+                for seq in self.running + new_sequences:
+                    if not seq.future.done():
+                        seq.future.set_exception(e)
+                self.running, self.input_ids, self.attention_mask, self.kv_cache = (
+                    [],
+                    None,
+                    None,
+                    None,
+                )
+                continue
+
+            for seq in finished:
+                seq.future.set_result(None)
+
+    @t.inference_mode()
+    def step(self, new_sequences: list[Sequence]) -> list[Sequence]:
+        """Admits `new_sequences`, decodes one token for every running sequence, and evicts the finished ones."""
+        if new_sequences:
+            self.admit(new_sequences)
+
+        # Run the last token of every row through the model, and sample the next tokens with each row's settings
+        logits = self.model(self.input_ids[:, -1:], self.kv_cache, self.attention_mask)[:, -1]
+        requests = [seq.request for seq in self.running]
+        next_tokens = TransformerSampler.sample_next_tokens(
+            self.input_ids,
+            logits,
+            temperature=self.per_row([r.temperature for r in requests], t.float),
+            top_k=self.per_row([r.top_k for r in requests], t.long),
+            top_p=self.per_row([r.top_p for r in requests], t.float),
+            frequency_penalty=self.per_row([r.frequency_penalty for r in requests], t.float),
+            attention_mask=self.attention_mask,
+            generator=[seq.generator for seq in self.running],
+        )
+        self.input_ids = t.cat([self.input_ids, next_tokens[:, None]], dim=-1)
+        self.attention_mask = F.pad(self.attention_mask, (0, 1), value=True)
+
+        # Record the new tokens, and find which sequences are done (we also stop at the context length)
+        now = time.perf_counter()
+        keep, finished = [], []
+        for i, (seq, token) in enumerate(zip(self.running, next_tokens.tolist())):
+            seq.new_token_ids.append(token)
+            if seq.first_token_time is None:
+                seq.first_token_time = now
+            if (
+                token == self.eos_token_id
+                or len(seq.new_token_ids) >= seq.request.max_tokens_generated
+                or len(seq.prompt_ids) + len(seq.new_token_ids) >= self.cfg.n_ctx
+            ):
+                finished.append(seq)
+            else:
+                keep.append(i)
+        self.step_history.append((now, len(self.running)))
+        self.n_tokens_generated += len(self.running)
+        self.n_requests_finished += len(finished)
+
+        if finished:
+            self.evict(keep)
+        return finished
+
+    def admit(self, new_sequences: list[Sequence]) -> None:
+        """
+        Runs each new prompt (except its last token) through the model to fill its cache, then adds it to the batch.
+        Every row is left-padded to the new longest row.
+        """
+        rows = []
+        if self.running:
+            rows.append((self.input_ids, self.attention_mask, self.kv_cache.entries))
+        for seq in new_sequences:
+            input_ids = t.tensor([seq.prompt_ids], device=device)
+            kv_cache = KeyValueCache(self.cfg)
+            if input_ids.size(1) > 1:
+                self.model(input_ids[:, :-1], kv_cache)
+            else:
+                # Nothing to cache yet, so start with empty keys & values
+                empty = t.zeros(1, 0, self.cfg.n_heads, self.cfg.d_head, device=device)
+                for entry in kv_cache.entries:
+                    entry.k, entry.v = empty, empty
+            rows.append((input_ids, t.ones_like(input_ids, dtype=t.bool), kv_cache.entries))
+
+        length = max(input_ids.size(1) for input_ids, _, _ in rows)
+        self.input_ids = t.cat([left_pad(ids, length, self.pad_token_id) for ids, _, _ in rows])
+        self.attention_mask = t.cat([left_pad(mask, length, False) for _, mask, _ in rows])
+        self.kv_cache = KeyValueCache(self.cfg)
+        for layer, entry in enumerate(self.kv_cache.entries):
+            entry.k = t.cat([left_pad(entries[layer].k, length - 1) for _, _, entries in rows])
+            entry.v = t.cat([left_pad(entries[layer].v, length - 1) for _, _, entries in rows])
+        self.running.extend(new_sequences)
+
+    def evict(self, keep: list[int]) -> None:
+        """Keeps only the rows in `keep`, and drops any columns which are now padding in every row."""
+        self.running = [self.running[i] for i in keep]
+        if not self.running:
+            self.input_ids, self.attention_mask, self.kv_cache = None, None, None
+            return
+
+        keep = t.tensor(keep, device=device)
+        attention_mask = self.attention_mask[keep]
+        start = attention_mask.any(0).int().argmax().item()
+        self.input_ids = self.input_ids[keep, start:]
+        self.attention_mask = attention_mask[:, start:]
+        self.kv_cache = self.kv_cache.select(keep)
+        for entry in self.kv_cache.entries:
+            entry.k, entry.v = entry.k[:, start:], entry.v[:, start:]
+
+    def per_row(self, values: list, dtype: t.dtype) -> float | Tensor:
+        """A sampling argument for `sample_next_tokens`: a scalar if every row agrees, else a tensor with one per row."""
+        if all(value == values[0] for value in values):
+            return values[0]
+        return t.tensor(values, dtype=dtype, device=device)
+
+
+async def route_request(
+    scheduler: ContinuousBatchingScheduler, reader: asyncio.StreamReader
+) -> tuple[HTTPStatus, dict]:
+    """Reads a single HTTP/1.1 request from `reader`, and returns the status & JSON response for it."""
+    try:
+        method, path, _ = (await reader.readline()).decode().split(" ", 2)
+        headers = {}
+        while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+            name, _, value = line.decode().partition(":")
+            headers[name.strip().lower()] = value.strip()
+        body = await reader.readexactly(int(headers.get("content-length", 0)))
+    except (ValueError, asyncio.IncompleteReadError) as e:
+        return HTTPStatus.BAD_REQUEST, {"error": f"Malformed request: {e}"}
+
+    if method == "GET" and path == "/metrics":
+        return HTTPStatus.OK, scheduler.metrics()
+    if method == "POST" and path == "/generate":
+        try:
+            request = GenerationRequest(**json.loads(body))
+        except (TypeError, ValueError) as e:
+            return HTTPStatus.BAD_REQUEST, {"error": str(e)}
+        return HTTPStatus.OK, await scheduler.generate(request)
+    return HTTPStatus.NOT_FOUND, {"error": f"No route for {method} {path}"}
+
+
+async def handle_http(
+    scheduler: ContinuousBatchingScheduler,
+    reader: asyncio.StreamReader,
+    writer: asyncio.StreamWriter,
+) -> None:
+    """
+    Handles a single HTTP/1.1 request: POST /generate (with a JSON `GenerationRequest`) or GET /metrics. Every request
+    gets a reply before the connection is closed, including malformed ones (400) and ones whose generation fails (500).
+    """
+    try:
+        try:
+            status, response = await route_request(scheduler, reader)
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+            status, response = HTTPStatus.INTERNAL_SERVER_ERROR, {"error": error}
+
+        payload = json.dumps(response).encode()
+        writer.write(
+            f"HTTP/1.1 {status.value} {status.phrase}\r\n"
+            f"Content-Type: application/json\r\nContent-Length: {len(payload)}\r\nConnection: close\r\n\r\n".encode()
+            + payload
+        )
+        await writer.drain()
+    finally:
+        writer.close()
+
+
+async def serve(scheduler: ContinuousBatchingScheduler, host="127.0.0.1", port=8000) -> None:
+    """Serves `scheduler` over HTTP, running its scheduler loop alongside the server."""
+    server = await asyncio.start_server(partial(handle_http, scheduler), host, port)
+    print(f"Serving on http://{host}:{port}")
+    async with server:
+        await asyncio.gather(server.serve_forever(), scheduler.run())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Continuous-batching server for DemoTransformer")
+    parser.add_argument(
+        "--model",
+        choices=["gpt2", "demo"],
+        default="gpt2",
+        help="GPT-2 small weights, or the small (untrained) demo model",
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--max-batch-size", type=int, default=32)
+    args = parser.parse_args()
+
+    t.set_grad_enabled(False)
+    if args.model == "gpt2":
+        from transformer_lens import HookedTransformer
+
+        reference_gpt2 = HookedTransformer.from_pretrained(
+            "gpt2-small", fold_ln=False, center_unembed=False, center_writing_weights=False
+        )
+        model = DemoTransformer(Config()).to(device)
+        model.load_state_dict(reference_gpt2.state_dict(), strict=False)
+        tokenizer = reference_gpt2.tokenizer
+    else:
+        tokenizer = GPT2TokenizerFast.from_pretrained("gpt2")
+        model_cfg = Config(
+            debug=False,
+            d_model=32,
+            n_heads=16,
+            d_head=2,
+            d_mlp=32 * 4,
+            n_layers=4,
+            n_ctx=128,
+            d_vocab=tokenizer.vocab_size,
+        )
+        model = DemoTransformer(model_cfg).to(device)
+
+    scheduler = ContinuousBatchingScheduler(model, tokenizer, max_batch_size=args.max_batch_size)
+    asyncio.run(serve(scheduler, args.host, args.port))
+
+
+if __name__ == "__main__":
+    main()
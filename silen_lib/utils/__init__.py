@@ -1,3 +1,3 @@
-from .utils import set_seed
+from .utils import set_seed, benchmark, peak_rss_mb
 
-__all__ = ["set_seed"]
\ No newline at end of file
+__all__ = ["set_seed", "benchmark", "peak_rss_mb"]
\ No newline at end of file
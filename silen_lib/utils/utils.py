@@ -1,9 +1,73 @@
+import ctypes
+import gc
+import threading
+import time
+import psutil
 import torch
 import random
 import numpy as np
 
-def set_seed(seed, deterministic=False):
+
+def set_seed(seed, deterministic=False, generator=None):
+    """
+    Seeds the global torch, `random` & numpy RNGs. If a `torch.Generator` is given, only it is seeded (and returned), so
+    a single request can be made reproducible without touching global state.
+    """
+    if generator is not None:
+        return generator.manual_seed(seed)
     torch.use_deterministic_algorithms(deterministic)
     torch.manual_seed(seed)
     random.seed(seed)
-    np.random.seed(seed)
\ No newline at end of file
+    np.random.seed(seed)
+
+
+def _synchronize():
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    elif torch.backends.mps.is_available():
+        torch.mps.synchronize()
+
+
+def benchmark(fn, n_iters=10, n_warmup=2):
+    """Returns the mean wall time of `fn()` in seconds, after `n_warmup` untimed calls."""
+    for _ in range(n_warmup):
+        fn()
+    _synchronize()
+    start = time.perf_counter()
+    for _ in range(n_iters):
+        fn()
+    _synchronize()
+    return (time.perf_counter() - start) / n_iters
+
+
+def _release_freed_memory():
+    """Returns freed heap memory to the OS where possible (glibc only), so it isn't counted in an RSS baseline."""
+    gc.collect()
+    try:
+        ctypes.CDLL("libc.so.6").malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
+
+
+def peak_rss_mb(fn, interval=1e-3):
+    """Returns how far the process RSS rose above its starting value while running `fn()`, in MB (sampled in a thread)."""
+    _release_freed_memory()
+    process = psutil.Process()
+    baseline = peak = process.memory_info().rss
+    done = threading.Event()
+
+    def poll():
+        nonlocal peak
+        while not done.is_set():
+            peak = max(peak, process.memory_info().rss)
+            time.sleep(interval)
+
+    thread = threading.Thread(target=poll, daemon=True)
+    thread.start()
+    try:
+        fn()
+    finally:
+        done.set()
+        thread.join()
+    peak = max(peak, process.memory_info().rss)
+    return (peak - baseline) / 1024**2